@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+from preprocessor import Preprocessor
+from naive_bayes import as_counts, MultinomialNaiveBayes, BinarizedMultinomialNaiveBayes
+from tester import Tester, featurize, print_scores
+from scipy.sparse import csr_matrix
+import numpy as np
+import getopt
+import sys
+
+def tune_alpha(p, alphas, folds = 5, bag_of_char_ngrams = False, ngram_len = 5, set_of_words = False,
+	num_buckets = None, cache = None, corpus = None):
+	""" Searches the best alpha for a feature set with k-fold cross-validation over the training data.
+	The feature set is the bag of words, unless bag_of_char_ngrams or set_of_words is True.
+	See test_authors for the rest of the arguments. Each document is featurized once.
+
+	Returns a 2-tuple of the best alpha and a dictionary of each alpha to the list of per-fold
+	score tuples.
+	"""
+	authors = list(p.get_authors())
+	search = AlphaSearch(authors, folds, binarized = set_of_words)
+	classifiers = (None if bag_of_char_ngrams or set_of_words else MultinomialNaiveBayes,
+		MultinomialNaiveBayes if bag_of_char_ngrams else None,
+		BinarizedMultinomialNaiveBayes if set_of_words and not bag_of_char_ngrams else None, None)
+	docs = [(author, data) for author in authors for data in p.training_data(author)]
+	paths = [p.file_path(author, data) for (author, data) in docs]
+	for ((author, data), (bag, ngrams, features)) in zip(docs, featurize(paths, classifiers, ngram_len, num_buckets, cache, corpus)):
+		search.add_document(author, ngrams if bag_of_char_ngrams else bag)
+	return search.search(alphas)
+
+class AlphaSearch:
+	""" Cross-validated search of the Laplace smoothing parameter of the
+	(Binarized) Multinomial Naive Bayes classifier.
+
+	The raw feature counts of every document are kept in a single sparse matrix.
+	The (sparse) class-by-feature counts of a fold's model are derived by subtracting
+	the counts of the fold from the counts of all documents, instead of retraining.
+	All alpha values of a fold are then scored in one vectorized pass over the
+	held-out documents. The predictions are the same as those of a classifier
+	trained on the other folds.
+	"""
+	def __init__(self, classes, folds = 5, binarized = False):
+		""" Initializes the search with the list of classes and the number of folds.
+		If binarized is True, the search is done for the Binarized Multinomial Naive Bayes
+		classifier instead.
+		"""
+		self.classes = dict(zip(classes, range(0, len(classes))))
+		self.class_indices = dict([reversed(i) for i in self.classes.items()])
+		self.folds = folds
+		self.binarized = binarized
+		self.features = {}
+		self.indices = []
+		self.data = []
+		self.indptr = [0]
+		self.labels = []
+		self.doc_folds = []
+		self.class_docs = [0] * len(classes)
+
+	def add_document(self, class_name, features, fold = None):
+		""" Adds the features of a single document of the given class.
+		If fold is not given, the documents of each class are dealt into the folds in turn,
+		so that the folds are stratified.
+
+		Parameter features is a dictionary of features to feature counts, or a 2-tuple
+		of feature id and count arrays.
+		"""
+		class_index = self.classes[class_name]
+		if fold is None:
+			fold = self.class_docs[class_index] % self.folds
+		self.class_docs[class_index] += 1
+		for (feature, fcount) in as_counts(features).items():
+			self.indices.append(self.features.setdefault(feature, len(self.features)))
+			self.data.append(fcount)
+		self.indptr.append(len(self.indices))
+		self.labels.append(class_index)
+		self.doc_folds.append(fold)
+
+	def search(self, alphas, metric = 2, max_cells = 2 ** 25):
+		""" Evaluates every given alpha value on every fold.
+		Metric is the index of the score (see Tester.scores) used for choosing
+		the best alpha, by its mean over the folds. Max_cells bounds the size of
+		the dense count and log probability tables that are built at once.
+
+		Returns a 2-tuple of the best alpha and a dictionary of each alpha to the list
+		of per-fold score tuples.
+		"""
+		alphas = np.asarray(alphas, dtype=np.float64)
+		num_classes = len(self.classes)
+		x = csr_matrix((self.data, self.indices, self.indptr), shape = (len(self.labels), len(self.features)), dtype=np.float64)
+		labels = np.array(self.labels, dtype=np.int64)
+		doc_folds = np.array(self.doc_folds, dtype=np.int64)
+		# One-hot class membership of the documents, so that the class counts are a matrix product.
+		membership = csr_matrix((np.ones(len(labels)), (labels, np.arange(len(labels)))), shape = (num_classes, len(labels)))
+		fold_counts = []
+		fold_docs = []
+		for fold in range(self.folds):
+			in_fold = csr_matrix(membership.multiply(doc_folds == fold))
+			fold_counts.append(csr_matrix(in_fold.dot(x)))
+			fold_docs.append(np.asarray(in_fold.sum(axis=1)).ravel())
+		total_counts = fold_counts[0]
+		for counts in fold_counts[1:]:
+			total_counts = total_counts + counts
+		total_docs = sum(fold_docs)
+
+		scores = dict((alpha, []) for alpha in alphas.tolist())
+		for fold in range(self.folds):
+			counts = total_counts - fold_counts[fold]
+			counts.eliminate_zeros()
+			docs = total_docs - fold_docs[fold]
+			test = x[doc_folds == fold]
+			if self.binarized:
+				counts = counts.minimum(1)
+			predicted = self.predict(counts, docs, test, alphas, max_cells)
+			gold = labels[doc_folds == fold]
+			for (g, alpha) in enumerate(alphas.tolist()):
+				t = Tester(self.classes)
+				t.add_stats(predicted[:,g], gold)
+				scores[alpha].append(t.scores())
+		means = [np.mean([s[metric] for s in scores[alpha]]) for alpha in alphas.tolist()]
+		return alphas.tolist()[int(np.nanargmax(means))], scores
+
+	def predict(self, counts, docs, test, alphas, max_cells):
+		""" Predicts the classes of the test documents for every alpha value, given the
+		sparse class-by-feature counts and class document counts of the training documents.
+		Features that have no counts in the training documents are out-of-vocabulary
+		features, which share a single column like in a trained classifier.
+
+		Only a slice of the in-vocabulary counts is made dense at a time, so that the
+		stacked log numerators of a batch of alphas have at most max_cells cells.
+
+		Returns a matrix of class indices with one row per document and one column per alpha.
+		"""
+		num_classes = counts.shape[0]
+		in_vocab = np.asarray(counts.sum(axis=0)).ravel() > 0
+		# Column slices of CSC matrices are cheap.
+		counts = counts.tocsc()[:,in_vocab]
+		num_features = counts.shape[1]
+		totals = np.asarray(counts.sum(axis=1)).ravel()
+		doc_arr = docs / np.sum(docs)
+		oov_counts = np.asarray(test[:,~in_vocab].sum(axis=1)).ravel()
+		test = test.tocsc()[:,in_vocab]
+		if self.binarized:
+			test = test.minimum(1)
+			oov_counts = np.minimum(oov_counts, 1)
+		lengths = np.asarray(test.sum(axis=1)).ravel() + oov_counts
+		predicted = np.empty((test.shape[0], len(alphas)), dtype=np.int64)
+		step = max(1, min(len(alphas), max_cells // max(1, num_classes * num_features)))
+		width = max(1, max_cells // (num_classes * step))
+		for start in range(0, len(alphas), step):
+			batch = alphas[start:start+step]
+			probs = np.zeros((test.shape[0], len(batch) * num_classes))
+			for f in range(0, num_features, width):
+				# The log numerators of all alphas are stacked into one (alphas * classes, features) table.
+				dense = counts[:,f:f+width].toarray()
+				numer = np.log(dense[np.newaxis,:,:] + batch[:,np.newaxis,np.newaxis]).reshape((-1, dense.shape[1]))
+				probs += test[:,f:f+width].dot(numer.T)
+			probs = probs.reshape((test.shape[0], len(batch), num_classes))
+			probs += np.multiply.outer(oov_counts, np.log(batch))[:,:,np.newaxis]
+			denom = np.log(totals[np.newaxis,:] + batch[:,np.newaxis] * num_features)
+			probs -= lengths[:,np.newaxis,np.newaxis] * denom[np.newaxis,:,:]
+			probs += doc_arr
+			predicted[:,start:start+len(batch)] = np.argmax(probs, axis=2)
+		return predicted
+
+if __name__ == '__main__':
+	""" This program accepts the same arguments as tester.py (the training and test directories,
+	or -m followed by a manifest path), but only uses the training set. The -a option followed by
+	a comma separated list of alpha values sets the grid, and the -k option followed by a number sets
+	the number of folds. The -n option searches for the bag of character n-grams instead of the
+	bag of words, and the -b option for the set of words.
+	"""
+	alphas = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1]
+	folds = 5
+	manifest_path = None
+	bag_of_char_ngrams = False
+	set_of_words = False
+	p = Preprocessor()
+	try:
+		optlist, argv = getopt.getopt(sys.argv[1:], 'a:k:m:nb', ["alphas=", "folds=", "manifest=", "ngrams", "binarized"])
+	except getopt.GetoptError as err:
+		print(err)
+		sys.exit(2)
+	for o, a in optlist:
+		if o in ("-a","--alphas"):
+			alphas = [float(alpha) for alpha in a.split(',')]
+		elif o in ("-k","--folds"):
+			folds = int(a)
+		elif o in ("-m","--manifest"):
+			manifest_path = a
+		elif o in ("-n","--ngrams"):
+			bag_of_char_ngrams = True
+		elif o in ("-b","--binarized"):
+			set_of_words = True
+		else:
+			assert False, "unhandled option"
+
+	if manifest_path is not None:
+		p.organize_authors(manifest_path = manifest_path)
+	elif len(argv) < 2:
+		print('Please enter training and test directories.')
+		sys.exit(2)
+	else:
+		p.organize_authors(argv[0], argv[1])
+	with np.errstate(divide='ignore', invalid='ignore'):
+		best, scores = tune_alpha(p, alphas, folds, bag_of_char_ngrams = bag_of_char_ngrams, set_of_words = set_of_words)
+		for alpha in alphas:
+			for (fold, fold_scores) in enumerate(scores[alpha]):
+				print('Scores for alpha', alpha, 'on fold', fold)
+				print_scores(fold_scores)
+		print('Best alpha:', best)
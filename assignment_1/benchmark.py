@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+from preprocessor import Preprocessor
+from tokenizer import Tokenizer
+from naive_bayes import MultinomialNaiveBayes
+import numpy as np
+import resource
+import platform
+import tempfile
+import shutil
+import getopt
+import json
+import time
+import os
+import sys
+
+# Parameters of the synthetic corpus: number of authors, documents per author, tokens per document and vocabulary size.
+presets = {
+	'small': { 'authors':10, 'documents':20, 'length':300, 'vocabulary':5000 },
+	'large': { 'authors':50, 'documents':100, 'length':2000, 'vocabulary':50000 },
+}
+syllables = ['a', 'e', 'ı', 'i', 'o', 'ö', 'u', 'ü', 'ba', 'be', 'ca', 'ce', 'ça', 'çe', 'da', 'de', 'ga', 'ge', 'ğı', 'ği',
+	'ha', 'he', 'ka', 'ke', 'la', 'le', 'lar', 'ler', 'ma', 'me', 'na', 'ne', 'pa', 'pe', 'ra', 're', 'sa', 'se', 'şa', 'şe',
+	'ta', 'te', 'ya', 'ye', 'za', 'ze', 'dır', 'dir', 'lık', 'lik', 'sın', 'sin', 'mış', 'miş', 'ın', 'in', 'ün', 'ör', 'ük', 'ış']
+punctuation = ['.', '.', '.', '?', '!', '...']
+
+def generate_vocabulary(rng, size):
+	""" Returns a list of size distinct Turkish-like words made of random syllables. """
+	words = []
+	seen = set()
+	while len(words) < size:
+		lengths = rng.randint(1, 5, size)
+		for word in (''.join(syllables[i] for i in rng.randint(0, len(syllables), n)) for n in lengths.tolist()):
+			if word not in seen:
+				seen.add(word)
+				words.append(word)
+	return words[:size]
+
+def generate_corpus(path, authors = 10, documents = 20, length = 300, vocabulary = 5000, seed = 0):
+	""" Writes a synthetic corpus in the layout of the dataset (one directory per author) in
+	Windows-1254 (Turkish) encoding. Words follow a Zipf distribution, and every author prefers
+	a random part of the vocabulary. Documents have sentences of varying length with commas,
+	capitalized words and numbers.
+
+	Returns the number of tokens written.
+	"""
+	rng = np.random.RandomState(seed)
+	words = generate_vocabulary(rng, vocabulary)
+	zipf = 1 / np.arange(1, vocabulary + 1)
+	zipf /= zipf.sum()
+	tokens = 0
+	for a in range(authors):
+		author_path = os.path.join(path, 'author{}'.format(a))
+		os.makedirs(author_path, exist_ok=True)
+		# Mix the common distribution with a Zipf distribution over a random ranking of the vocabulary.
+		cumulative = np.cumsum(0.8 * zipf + 0.2 * zipf[rng.permutation(vocabulary)])
+		for d in range(documents):
+			n = max(1, int(rng.normal(length, length / 4)))
+			ids = np.minimum(np.searchsorted(cumulative, rng.random_sample(n) * cumulative[-1]), vocabulary - 1)
+			doc = [words[i] for i in ids.tolist()]
+			sentences = []
+			start = 0
+			while start < n:
+				stop = min(n, start + rng.randint(4, 20))
+				sentence = doc[start:stop]
+				sentence[0] = sentence[0].capitalize()
+				if rng.random_sample() < 0.4: sentence[rng.randint(len(sentence))] += ','
+				if rng.random_sample() < 0.1: sentence[rng.randint(len(sentence))] = str(rng.randint(1, 2000))
+				sentences.append(' '.join(sentence) + punctuation[rng.randint(len(punctuation))])
+				start = stop
+			with open(os.path.join(author_path, 'doc{}.txt'.format(d)), 'w', encoding = 'cp1254') as f:
+				f.write('\n'.join(sentences))
+			tokens += n
+	return tokens
+
+def peak_rss():
+	""" Returns the peak resident set size of the process since it started, or since the last
+	reset_peak_rss(), in kilobytes.
+	"""
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss // 1024 if sys.platform == 'darwin' else rss
+
+def reset_peak_rss():
+	""" Resets the peak resident set size of the process to its current size, so that the
+	next peak_rss() is the peak of what runs in between. This is only possible on Linux.
+
+	Returns True if the peak was reset.
+	"""
+	try:
+		with open('/proc/self/clear_refs', 'w') as f:
+			f.write('5')
+		return True
+	except OSError:
+		return False
+
+class Timer:
+	""" Times the stages of a benchmark and records their throughputs and memory usage. """
+	def __init__(self):
+		self.stages = {}
+		self.process_peak_rss = peak_rss()
+
+	def stage(self, name, func, documents = None, tokens = None):
+		""" Runs a stage and records its time, throughput and the peak RSS of the process so far.
+		Where the peak can be reset, the peak RSS during the stage itself is recorded too.
+		The number of tokens can also be a function of the result of the stage.
+
+		Returns the result of func().
+		"""
+		# Resetting the peak also resets ru_maxrss, so the peak of the process is kept here.
+		self.process_peak_rss = max(self.process_peak_rss, peak_rss())
+		reset = reset_peak_rss()
+		start = time.perf_counter()
+		result = func()
+		seconds = time.perf_counter() - start
+		stage_peak_rss = peak_rss()
+		self.process_peak_rss = max(self.process_peak_rss, stage_peak_rss)
+		if callable(tokens):
+			tokens = tokens(result)
+		stats = { 'seconds':seconds, 'process_peak_rss_kb':self.process_peak_rss }
+		if reset:
+			stats['stage_peak_rss_kb'] = stage_peak_rss
+		if documents is not None:
+			stats['docs_per_sec'] = documents / seconds if seconds > 0 else None
+		if tokens is not None:
+			stats['tokens_per_sec'] = tokens / seconds if seconds > 0 else None
+		self.stages[name] = stats
+		print(name, json.dumps(stats), file = sys.stderr)
+		return result
+
+def run_benchmark(path, authors = 10, documents = 20, length = 300, vocabulary = 5000, seed = 0, alpha = 0.05):
+	""" Runs the pipeline stages on a synthetic corpus generated in the given directory.
+
+	Returns a JSON serializable dictionary of the parameters, the environment and the stats of each stage.
+	"""
+	timer = Timer()
+	corpus_path = os.path.join(path, 'corpus')
+	num_docs = authors * documents
+	num_tokens = timer.stage('generate', lambda: generate_corpus(corpus_path, authors, documents, length, vocabulary, seed), num_docs)
+	p = Preprocessor()
+	timer.stage('organize_dataset', lambda: p.organize_dataset(seed, corpus_path), num_docs)
+	p.organize_authors()
+	names = sorted(p.get_authors())
+
+	training = [(author, p.file_path(author, data)) for author in names for data in p.training_data(author)]
+	test = [(author, p.file_path(author, data, training_data = False)) for author in names for data in p.test_data(author)]
+	# Tokenization is timed on its own, so the later stages reuse the bags of words.
+	training_bags = timer.stage('tokenize', lambda: [Tokenizer(doc_path).bag_of_words() for (author, doc_path) in training],
+		len(training), lambda bags: sum(sum(bag.values()) for bag in bags))
+	test_bags = [Tokenizer(doc_path).bag_of_words() for (author, doc_path) in test]
+	training_tokens = sum(sum(bag.values()) for bag in training_bags)
+
+	clsf = MultinomialNaiveBayes(names, alpha = alpha)
+	def train():
+		for author in names:
+			clsf.add_documents(author, len(p.training_data(author)))
+		for ((author, doc_path), bag) in zip(training, training_bags):
+			clsf.add_feature_counts(author, bag)
+		clsf.train()
+	timer.stage('train', train, len(training), training_tokens)
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		vectors = timer.stage('vectorize', lambda: [clsf.vectorize(bag) for bag in test_bags], len(test))
+		timer.stage('most_probable_class', lambda: [clsf.most_probable_class(vec) for vec in vectors], len(test))
+		feature_mat = timer.stage('vectorize_batch', lambda: clsf.vectorize_batch(test_bags), len(test))
+		timer.stage('predict_batch', lambda: clsf.predict_batch(feature_mat), len(test))
+
+	model_path = os.path.join(path, 'model.nbm')
+	clsf.save(model_path)
+	return { 'params':{ 'authors':authors, 'documents':documents, 'length':length, 'vocabulary':vocabulary, 'seed':seed,
+		'alpha':alpha }, 'environment':{ 'python':platform.python_version(), 'numpy':np.__version__, 'platform':platform.platform() },
+		'corpus':{ 'documents':num_docs, 'tokens':num_tokens, 'features':len(clsf.features) },
+		'model_bytes':os.path.getsize(model_path), 'table_bytes':clsf.class_features.nbytes, 'stages':timer.stages }
+
+def compare(old, new):
+	""" Prints the ratio of the time of each stage in the new results to that in the old results. """
+	for (name, stats) in new['stages'].items():
+		if name in old['stages']:
+			print('{}: {:.3f}s -> {:.3f}s ({:.2f}x)'.format(name, old['stages'][name]['seconds'], stats['seconds'],
+				old['stages'][name]['seconds'] / stats['seconds'] if stats['seconds'] > 0 else float('inf')))
+	print('model_bytes: {} -> {}'.format(old['model_bytes'], new['model_bytes']))
+
+if __name__ == '__main__':
+	""" Benchmarks the pipeline on a synthetic corpus and writes the results as JSON. The -p option followed
+	by small or large selects a preset (small by default). The -a, -d, -l and -v options followed by a number
+	override the number of authors, the documents per author, the tokens per document and the vocabulary size
+	of the preset. The -s option followed by a number sets the random seed. The -o option followed by a path
+	writes the results to that path instead of the standard output. The -w option followed by a directory
+	keeps the corpus in that directory instead of a temporary one. The -c option followed by two result paths
+	compares them instead of running a benchmark.
+	"""
+	params = dict(presets['small'])
+	overrides = {}
+	seed = 0
+	output_path = None
+	work_path = None
+	try:
+		optlist, argv = getopt.getopt(sys.argv[1:], 'p:a:d:l:v:s:o:w:c', ["preset=", "authors=", "documents=", "length=",
+			"vocabulary=", "seed=", "output=", "work=", "compare"])
+	except getopt.GetoptError as err:
+		print(err)
+		sys.exit(2)
+	for o, a in optlist:
+		if o in ("-p","--preset"):
+			params = dict(presets[a])
+		elif o in ("-a","--authors"):
+			overrides['authors'] = int(a)
+		elif o in ("-d","--documents"):
+			overrides['documents'] = int(a)
+		elif o in ("-l","--length"):
+			overrides['length'] = int(a)
+		elif o in ("-v","--vocabulary"):
+			overrides['vocabulary'] = int(a)
+		elif o in ("-s","--seed"):
+			seed = int(a)
+		elif o in ("-o","--output"):
+			output_path = a
+		elif o in ("-w","--work"):
+			work_path = a
+		elif o in ("-c","--compare"):
+			if len(argv) < 2:
+				print('Please enter two result paths.')
+				sys.exit(2)
+			with open(argv[0]) as f_old, open(argv[1]) as f_new:
+				compare(json.load(f_old), json.load(f_new))
+			sys.exit(0)
+		else:
+			assert False, "unhandled option"
+	params.update(overrides)
+
+	path = tempfile.mkdtemp() if work_path is None else work_path
+	try:
+		results = run_benchmark(path, seed = seed, **params)
+	finally:
+		if work_path is None:
+			shutil.rmtree(path, ignore_errors=True)
+	text = json.dumps(results, indent = 2)
+	if output_path is None:
+		print(text)
+	else:
+		with open(output_path, 'w') as f:
+			f.write(text)
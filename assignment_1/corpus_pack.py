@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+from tokenizer import Tokenizer
+import json
+import mmap
+import os
+import struct
+import sys
+
+# Every shard starts with the magic bytes and the length of its index.
+magic = b'CMPESHRD'
+header = struct.Struct('<8sQ')
+
+def pack(path, shard_path, shard_size = None):
+	""" Packs an author directory tree into shard files.
+	Each shard holds a header, a JSON index of the authors, file names, offsets
+	and lengths of its texts, and the raw bytes of the texts. The texts are kept
+	in their original encoding. If shard_size is given, a new shard is started
+	whenever a shard exceeds that many bytes of text, in which case shard_path must
+	contain a {} to be replaced with the shard index.
+
+	Returns the list of shard paths.
+	"""
+	path = os.path.normpath(path)
+	docs = [(author, text) for author in sorted(os.listdir(path)) for text in sorted(os.listdir(os.path.join(path, author)))]
+	groups = [[]]
+	group_size = 0
+	for (author, text) in docs:
+		size = os.path.getsize(os.path.join(path, author, text))
+		if shard_size is not None and group_size > 0 and group_size + size > shard_size:
+			groups.append([])
+			group_size = 0
+		groups[-1].append((author, text, size))
+		group_size += size
+	paths = []
+	for (i, group) in enumerate(groups):
+		paths.append(shard_path.format(i) if shard_size is not None else shard_path)
+		write_shard(path, paths[-1], group)
+	return paths
+
+def write_shard(path, shard_path, docs):
+	""" Writes the given (author, file name, size) tuples of a dataset to a single shard. """
+	authors = sorted(set(author for (author, text, size) in docs))
+	labels = dict(zip(authors, range(len(authors))))
+	offsets = []
+	offset = 0
+	for (author, text, size) in docs:
+		offsets.append(offset)
+		offset += size
+	index = json.dumps({ 'authors':authors, 'labels':[labels[author] for (author, text, size) in docs],
+		'names':[text for (author, text, size) in docs], 'offsets':offsets,
+		'lengths':[size for (author, text, size) in docs] }, ensure_ascii=False).encode('utf-8')
+	with open(shard_path, 'wb') as f:
+		f.write(header.pack(magic, len(index)))
+		f.write(index)
+		for (author, text, size) in docs:
+			with open(os.path.join(path, author, text), 'rb') as doc:
+				f.write(doc.read())
+
+class Shard:
+	""" A memory-mapped reader of a single shard. """
+	def __init__(self, path):
+		self.path = path
+		self.open()
+
+	def open(self):
+		""" Memory maps the shard and reads its index. """
+		with open(self.path, 'rb') as f:
+			self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		mag, index_len = header.unpack_from(self.map, 0)
+		if mag != magic:
+			raise ValueError('Not a corpus shard: ' + self.path)
+		index = json.loads(self.map[header.size:header.size+index_len].decode('utf-8'))
+		self.data_offset = header.size + index_len
+		self.authors = index['authors']
+		self.labels = index['labels']
+		self.names = index['names']
+		self.offsets = index['offsets']
+		self.lengths = index['lengths']
+
+	def __getstate__(self):
+		# The memory map cannot be sent to other processes, so it is reopened there.
+		return { 'path':self.path }
+
+	def __setstate__(self, state):
+		self.path = state['path']
+		self.open()
+
+	def __len__(self):
+		return len(self.names)
+
+	def author(self, i):
+		""" Returns the author of the i'th text. """
+		return self.authors[self.labels[i]]
+
+	def document(self, i):
+		""" Returns the raw bytes of the i'th text as a memoryview of the shard, without copying. """
+		start = self.data_offset + self.offsets[i]
+		return memoryview(self.map)[start:start+self.lengths[i]]
+
+class PackedCorpus:
+	""" A reader of a dataset packed into one or more shards.
+	Texts are looked up by author and file name, which are also the last two components
+	of the paths given by the Preprocessor, so it can be used in place of the file system.
+	"""
+	def __init__(self, shard_paths):
+		if isinstance(shard_paths, str):
+			shard_paths = [shard_paths]
+		self.shards = [Shard(path) for path in shard_paths]
+		self.build_index()
+
+	def build_index(self):
+		""" Maps each (author, file name) pair to its shard and index. """
+		self.index = {}
+		for shard in self.shards:
+			for i in range(len(shard)):
+				self.index[(shard.author(i), shard.names[i])] = (shard, i)
+
+	def __getstate__(self):
+		return { 'shards':self.shards }
+
+	def __setstate__(self, state):
+		self.shards = state['shards']
+		self.build_index()
+
+	def get_authors(self):
+		""" Returns the list of authors in the corpus. """
+		return sorted(set(author for (author, name) in self.index.keys()))
+
+	def document(self, author, name):
+		""" Returns the raw bytes of a text as a memoryview. """
+		shard, i = self.index[(author, name)]
+		return shard.document(i)
+
+	def tokenizer(self, path, **kwargs):
+		""" Returns a tokenizer for the text at the given dataset path.
+		Only the author directory and the file name of the path are used.
+		Keyword arguments are passed to the Tokenizer.
+		"""
+		return Tokenizer(buffer = self.document(os.path.basename(os.path.dirname(path)), os.path.basename(path)), **kwargs)
+
+if __name__ == '__main__':
+	""" Accepts two arguments: the dataset directory and the shard path. If used, the -s option
+	followed by a number of bytes splits the dataset into shards of roughly that size, in which
+	case the shard path must contain a {} to be replaced with the shard index.
+	"""
+	argv = sys.argv[1:]
+	shard_size = None
+	if len(argv) > 1 and argv[0] == '-s':
+		shard_size = int(argv[1])
+		argv = argv[2:]
+	if len(argv) < 2:
+		print('Please enter the dataset directory and the shard path.')
+		sys.exit(2)
+	for path in pack(argv[0], argv[1], shard_size):
+		print('Shard path:', path)
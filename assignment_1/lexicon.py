@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import os
+import sys
+import csv
+
+# Relative lexicon paths are resolved against the directory of this package.
+package_dir = os.path.dirname(os.path.abspath(__file__))
+# Stop words are taken from http://www.turkceogretimi.com/Genel-Konular/article/541-turkce-etkisiz-kelimeler-stop-words-listesi-11/35
+default_paths = ('stopwords-tr.csv',)
+
+# Loaded word sets, shared by all lexicons that are made of the same files.
+loaded = {}
+
+def resolve(path):
+	""" Returns the absolute path of a lexicon file. """
+	return os.path.normpath(path if os.path.isabs(path) else os.path.join(package_dir, path))
+
+def load(paths):
+	""" Reads the given comma separated lexicon files into a single frozenset.
+	The result is cached, so each set of files is only read once.
+	"""
+	if paths not in loaded:
+		words = set([])
+		for path in paths:
+			with open(path, 'r', encoding = 'utf-8') as f:
+				words.update(word for line in csv.reader(f) for word in line)
+		loaded[paths] = frozenset(words)
+	return loaded[paths]
+
+class Lexicon:
+	""" A lazily loaded word list with constant time lookup.
+	The files are not read until the first lookup. Keeps track of the
+	lookups that are found (hits) and not found (misses) in the lexicon.
+	"""
+	def __init__(self, paths = default_paths):
+		""" Initializes the lexicon with a path or a list of paths.
+		Relative paths are resolved against the package directory.
+		"""
+		if isinstance(paths, str):
+			paths = (paths,)
+		self.paths = tuple(resolve(path) for path in paths)
+		self.words = None
+		self.hits = 0
+		self.misses = 0
+
+	def get_words(self):
+		""" Returns the frozenset of words, loading it if necessary. """
+		if self.words is None:
+			self.words = load(self.paths)
+		return self.words
+
+	def __contains__(self, word):
+		if self.words is None:
+			self.get_words()
+		if word in self.words:
+			self.hits += 1
+			return True
+		self.misses += 1
+		return False
+
+	def __len__(self):
+		return len(self.get_words())
+
+	def stats(self):
+		""" Returns a 3-tuple of the number of hits, misses and the hit ratio. """
+		total = self.hits + self.misses
+		return self.hits, self.misses, self.hits / total if total > 0 else 0.0
+
+	def add_stats(self, hits, misses):
+		""" Adds to the hit and miss counters the lookups that are done on the frozenset
+		of get_words() directly, which avoids a method call for each word.
+		"""
+		self.hits += hits
+		self.misses += misses
+
+	def reset_stats(self):
+		""" Resets the hit and miss counters. """
+		self.hits = 0
+		self.misses = 0
+
+if __name__ == '__main__':
+	""" Accepts any number of lexicon paths and prints the size of the lexicon. """
+	lexicon = Lexicon(sys.argv[1:]) if len(sys.argv) > 1 else Lexicon()
+	print('Lexicon size:', len(lexicon))
@@ -1,12 +1,234 @@
 #!/usr/bin/env python3
 from preprocessor import Preprocessor
 from tokenizer import Tokenizer
+from ngrams import merge_counts
 from collections import Counter
-from scipy.stats import norm
+from scipy.sparse import csr_matrix, issparse, vstack
 import numpy as np
+import copy
+import json
 import math
+import mmap
+import struct
 import sys
 
+# Saved models start with the magic bytes and the length of the JSON header.
+model_magic = b'CMPENBMD'
+model_header = struct.Struct('<8sQ')
+# Arrays in saved models are aligned to this many bytes.
+model_alignment = 64
+
+def as_counts(features):
+	""" Returns the dictionary of features to feature counts for the given features.
+	The features can either be a dictionary or a 2-tuple of feature id and count arrays,
+	as returned by the hashed n-gram extractor.
+	"""
+	if isinstance(features, tuple):
+		return Counter(dict(zip(features[0].tolist(), features[1].tolist())))
+	return features
+
+class SparseCounts:
+	""" Counts of hashed feature ids, kept as a sorted array of unique ids and an array of their
+	counts, so that the memory usage depends on the number of distinct ids, not on the number of
+	buckets. Added arrays are buffered and merged with the sorted arrays (see merge_counts) once
+	they hold as many entries, so adding costs amortized time proportional to the added entries.
+	"""
+	def __init__(self):
+		self.ids = np.zeros((0,), dtype=np.int64)
+		self.counts = np.zeros((0,), dtype=np.int64)
+		self.pending = []
+		self.num_pending = 0
+
+	def add(self, ids, counts):
+		""" Adds the given arrays of feature ids and their counts. """
+		self.pending.append((np.asarray(ids, dtype=np.int64), np.asarray(counts, dtype=np.int64)))
+		self.num_pending += len(self.pending[-1][0])
+		if self.num_pending >= len(self.ids):
+			self.compact()
+
+	def compact(self):
+		""" Merges the buffered arrays into the sorted arrays. """
+		if len(self.pending) == 0:
+			return
+		self.ids, self.counts = merge_counts(np.concatenate([self.ids] + [ids for (ids, counts) in self.pending]),
+			np.concatenate([self.counts] + [counts for (ids, counts) in self.pending]))
+		self.pending = []
+		self.num_pending = 0
+
+	def arrays(self):
+		""" Returns the 2-tuple of the sorted unique ids and their counts. """
+		self.compact()
+		return self.ids, self.counts
+
+	def __len__(self):
+		return len(self.arrays()[0])
+
+	def __getstate__(self):
+		# Only the sorted arrays are sent to other processes.
+		self.compact()
+		return self.__dict__
+
+def update_counts(acc, counts):
+	""" Adds feature counts to accumulated feature counts, in place where possible.
+	Dictionaries (or iterables of features) are added to a Counter. 2-tuples of feature id and
+	count arrays, as returned by the hashed n-gram extractor, and other SparseCounts are added to
+	a SparseCounts, which replaces an empty Counter, so that hashed features never become Python objects.
+
+	Returns the updated counts.
+	"""
+	if isinstance(counts, tuple) or isinstance(counts, SparseCounts):
+		if not isinstance(acc, SparseCounts):
+			if len(acc) > 0:
+				raise ValueError('Arrays of feature counts cannot be added to a dictionary of feature counts')
+			acc = SparseCounts()
+		acc.add(*(counts.arrays() if isinstance(counts, SparseCounts) else counts))
+		return acc
+	if isinstance(acc, SparseCounts):
+		if len(counts) > 0:
+			raise ValueError('A dictionary of feature counts cannot be added to an array of feature counts')
+		return acc
+	acc.update(counts)
+	return acc
+
+def update_doc_freq(doc_freq, counts):
+	""" Adds the features of a single document to document frequencies (see update_counts).
+
+	Returns the updated document frequencies.
+	"""
+	if isinstance(counts, tuple):
+		ids = np.unique(counts[0])
+		return update_counts(doc_freq, (ids, np.ones(len(ids), dtype=np.int64)))
+	return update_counts(doc_freq, counts.keys())
+
+def count_arrays(counts):
+	""" Returns the sorted id and count arrays of a SparseCounts (see update_counts).
+	An empty Counter gives empty arrays.
+	"""
+	if isinstance(counts, SparseCounts):
+		return counts.arrays()
+	if len(counts) > 0:
+		raise ValueError('A dictionary of feature counts cannot be used as arrays of feature counts')
+	return np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64)
+
+class CountAccumulator:
+	""" Accumulates the feature counts and document frequencies of each class.
+	Counts are added in place, so adding a document costs (amortized) time proportional to its
+	number of features. Accumulators built separately (ex: in worker processes over chunks of the
+	training set) can be merged, and merging is associative. Merging in the order of the
+	documents gives the same features in the same order as adding the documents one by one.
+	"""
+	def __init__(self, track_df = False):
+		""" Initializes an empty accumulator. If track_df is True, the number of documents
+		each feature occurs in is also accumulated.
+		"""
+		self.class_data = {}
+		self.doc_freq = Counter() if track_df else None
+
+	def add_feature_counts(self, class_name, counts):
+		""" Adds the features of a document to a class.
+		Parameter counts is a dictionary of features to feature counts, or a 2-tuple
+		of feature id and count arrays, which are accumulated as SparseCounts (see update_counts).
+		"""
+		self.class_data[class_name] = update_counts(self.class_data.get(class_name, Counter()), counts)
+		if self.doc_freq is not None:
+			self.doc_freq = update_doc_freq(self.doc_freq, counts)
+
+	def merge(self, other):
+		""" Adds the counts of another accumulator to this one in place.
+		Hashed counts are merged as sorted id and count arrays (see SparseCounts), so merging
+		costs time proportional to the distinct ids of the other accumulator, not to the number of buckets.
+
+		Returns this accumulator.
+		"""
+		for (class_name, counts) in other.class_data.items():
+			self.class_data[class_name] = update_counts(self.class_data.get(class_name, Counter()), counts)
+		if self.doc_freq is not None and other.doc_freq is not None:
+			self.doc_freq = update_counts(self.doc_freq, other.doc_freq)
+		return self
+
+def feature_keys(features):
+	""" Returns the keys of the given list of string features or array of feature ids as an array.
+	Feature ids are their own keys, and string features are encoded into fixed-width UTF-8 bytes,
+	which sort in the order of their code points.
+	"""
+	if isinstance(features, np.ndarray) or all(isinstance(feature, int) for feature in features):
+		return np.asarray(features, dtype=np.int64)
+	return np.array([feature.encode('utf-8') for feature in features], dtype=np.bytes_)
+
+class FeatureIndex:
+	""" Maps the features of a classifier to their columns.
+	The keys of the features (see feature_keys) are kept in a sorted array, so that the columns of
+	a whole list of features are found with a single searchsorted, without a dictionary. The arrays
+	can be memory-mapped from a saved model and used in place, so loading does not depend on the
+	size of the vocabulary and processes share a single copy of them.
+	"""
+	def __init__(self, sorted_keys, columns):
+		""" Initializes the index with the sorted array of keys and the array of their columns. """
+		self.sorted_keys = sorted_keys
+		self.columns = columns
+
+	def __len__(self):
+		return len(self.sorted_keys)
+
+	def __contains__(self, feature):
+		return self.get(feature) is not None
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def get(self, feature, default = None):
+		""" Returns the column of a single feature, or default if it is unknown. """
+		column = int(self.lookup([feature])[0])
+		return default if column < 0 else column
+
+	def lookup(self, features):
+		""" Returns the array of the columns of the given list (or array of ids) of features,
+		with -1 for unknown features.
+		"""
+		if len(self.sorted_keys) == 0:
+			return np.full((len(features),), -1, dtype=np.int64)
+		if self.sorted_keys.dtype.kind == 'S':
+			encoded = [feature.encode('utf-8') for feature in features]
+			keys = np.array(encoded, dtype=self.sorted_keys.dtype)
+			# Longer features are not in the vocabulary, but their truncated keys could be.
+			fits = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)) <= self.sorted_keys.dtype.itemsize
+		else:
+			keys = np.asarray(features, dtype=np.int64)
+			fits = True
+		# Searching in sorted order keeps the accesses to the sorted keys local.
+		order = np.argsort(keys)
+		pos = np.empty((len(keys),), dtype=np.int64)
+		pos[order] = np.minimum(np.searchsorted(self.sorted_keys, keys[order]), len(self.sorted_keys) - 1)
+		return np.where((self.sorted_keys[pos] == keys) & fits, self.columns[pos], -1)
+
+	def keys(self):
+		""" Returns the list of features in the order of their columns. """
+		keys = self.sorted_keys[np.argsort(self.columns)].tolist()
+		return [key.decode('utf-8') for key in keys] if self.sorted_keys.dtype.kind == 'S' else keys
+
+	def add(self, features):
+		""" Adds the given list of new string features or array of new feature ids as the next columns. """
+		keys = feature_keys(features)
+		if len(keys) == 0:
+			return
+		if len(self) == 0 or keys.dtype.itemsize > self.sorted_keys.dtype.itemsize:
+			# Longer string features widen the keys.
+			self.sorted_keys = self.sorted_keys.astype(keys.dtype)
+		columns = np.arange(len(self), len(self) + len(keys))
+		# The new keys are inserted into the sorted keys, instead of sorting all of them again.
+		order = np.argsort(keys, kind='stable')
+		pos = np.searchsorted(self.sorted_keys, keys[order], side='right')
+		self.sorted_keys = np.insert(self.sorted_keys, pos, keys[order])
+		self.columns = np.insert(self.columns, pos, columns[order])
+
+def feature_index(features):
+	""" Returns the FeatureIndex of the given list of string features or array of feature ids,
+	whose columns are their positions.
+	"""
+	keys = feature_keys(features)
+	order = np.argsort(keys, kind='stable')
+	return FeatureIndex(keys[order], order)
+
 class NaiveBayes:
 	""" Base class for Naive Bayes implementations.
 	Defines the method of calculating the most probable class.
@@ -51,15 +273,116 @@ class NaiveBayes:
 		pos_probs = probs-np.min(probs)
 		return pos_probs / np.max(pos_probs)
 
+	def save(self, path):
+		""" Saves the trained classifier to a single binary file.
+		The file has a JSON header describing the classifier, followed by its arrays
+		in raw form, so that they can be memory-mapped by load().
+		"""
+		meta, arrays = self.get_state()
+		meta['type'] = type(self).__name__
+		meta['classes'] = [self.class_indices[i] for i in range(len(self.classes))]
+		arrays['documents'] = self.documents
+		arrays['doc_arr'] = self.doc_arr
+		meta['arrays'] = {}
+		offset = 0
+		for (name, arr) in arrays.items():
+			arr = np.ascontiguousarray(arr)
+			meta['arrays'][name] = { 'dtype':arr.dtype.str, 'shape':arr.shape, 'offset':offset }
+			offset += -(-arr.nbytes // model_alignment) * model_alignment
+		header = json.dumps(meta, ensure_ascii=False).encode('utf-8')
+		data_offset = -(-(model_header.size + len(header)) // model_alignment) * model_alignment
+		with open(path, 'wb') as f:
+			f.write(model_header.pack(model_magic, len(header)))
+			f.write(header)
+			f.write(b'\0' * (data_offset - model_header.size - len(header)))
+			for (name, arr) in arrays.items():
+				arr = np.ascontiguousarray(arr)
+				f.write(arr.tobytes())
+				f.write(b'\0' * (-(-arr.nbytes // model_alignment) * model_alignment - arr.nbytes))
+
+	def get_state(self):
+		""" Returns the state of the trained classifier to be saved, as a 2-tuple of
+		a JSON serializable dictionary and a dictionary of names to arrays.
+		"""
+		return {}, {}
+
+	def set_state(self, meta, arrays):
+		""" Restores the state returned by get_state(). """
+		pass
+
+	def select_classes(self, start, stop):
+		""" Returns a copy of the trained classifier that only holds the classes with indices
+		in [start, stop). The class base probabilities are not renormalized, so the log
+		probabilities of the selected classes stay the same as those of this classifier.
+		Arrays are sliced, not copied, wherever possible.
+		"""
+		model = copy.copy(self)
+		names = [self.class_indices[i] for i in range(start, stop)]
+		model.classes = dict(zip(names, range(0, len(names))))
+		model.class_indices = dict([reversed(i) for i in model.classes.items()])
+		model.documents = self.documents[start:stop]
+		model.doc_arr = self.doc_arr[start:stop]
+		return model
+
 	def calculate_class_log_probability(self, feature_vec):
-		""" Gets the log probabilities of the feature vector with respect to classes. """
+		""" Gets the log probabilities of the feature vector with respect to classes.
+		If a matrix of feature vectors (one row per document) is given, a matrix with
+		one row of class log probabilities per document is returned.
+		"""
 		pass
 
+	def vectorize_batch(self, features_list):
+		""" Vectorizes a list of feature sets into a matrix with one row per document. """
+		return np.array([self.vectorize(features) for features in features_list])
+
+	def log_proba_batch(self, feature_mat, batch_size = None):
+		""" Returns the log probabilities of all classes for a matrix of feature vectors,
+		which can be dense or sparse, as a matrix with one row per document. Each batch
+		of batch_size documents (all of them, if not given) is scored with a single
+		matrix multiplication.
+		"""
+		num_docs = feature_mat.shape[0]
+		batch_size = max(1, num_docs if batch_size is None else batch_size)
+		probs = np.empty((num_docs, len(self.classes)))
+		for start in range(0, num_docs, batch_size):
+			probs[start:start+batch_size] = self.doc_arr + self.calculate_class_log_probability(feature_mat[start:start+batch_size])
+		return probs
+
+	def predict_batch(self, feature_mat, batch_size = None):
+		""" Returns the most probable classes for a matrix of feature vectors.
+		Only one batch of class log probabilities is kept in memory at a time.
+
+		Returns a 2-tuple of the array of class indices (see self.class_indices) and
+		the array of their log probabilities.
+		"""
+		num_docs = feature_mat.shape[0]
+		batch_size = max(1, num_docs if batch_size is None else batch_size)
+		indices = np.empty((num_docs,), dtype=np.int64)
+		scores = np.empty((num_docs,))
+		for start in range(0, num_docs, batch_size):
+			probs = self.log_proba_batch(feature_mat[start:start+batch_size])
+			indices[start:start+batch_size] = np.argmax(probs, axis=1)
+			scores[start:start+batch_size] = probs[np.arange(probs.shape[0]), indices[start:start+batch_size]]
+		return indices, scores
+
 class MultinomialNaiveBayes(NaiveBayes):
 	""" Implementation of Multinomial Naive Bayes classifier. """
-	def __init__(self, classes, alpha = 1):
+	def __init__(self, classes, alpha = 1, sparse = False, dtype = np.float64, min_count = None, min_df = None,
+		top_k = None, keep_counts = True):
 		""" Constructs a multinomial naive bayes classifier.
 		Alpha is the Laplace smoothing parameter.
+
+		If sparse is True, the trained model is stored as a per-class log probability
+		of unseen features plus a sparse matrix of the differences for the seen features.
+		Dtype is the float type of the trained model (ex: np.float32 to halve its size).
+
+		The vocabulary can be pruned at training time. Min_count drops the features
+		that occur less than that many times in total, min_df drops the features
+		that occur in less than that many documents, and top_k keeps only the features
+		that are among the top_k most frequent features of at least one class. Pruned
+		features are treated as out-of-vocabulary features.
+
+		If keep_counts is False, the raw feature counts are freed after training.
 		"""
 		NaiveBayes.__init__(self, classes)
 		self.class_data = {}
@@ -67,49 +390,365 @@ class MultinomialNaiveBayes(NaiveBayes):
 			self.class_data[class_name] = Counter()
 		self.alpha = alpha
 		self.class_features = [[]]
-		self.features = {}
+		self.features = feature_index([])
+		self.sparse = sparse
+		self.dtype = dtype
+		self.min_count = min_count
+		self.min_df = min_df
+		self.top_k = top_k
+		self.keep_counts = keep_counts
+		self.doc_freq = Counter() if min_df is not None else None
+		self.class_base = None
+		self.class_totals = None
+		self.updated_rows = {}
 
-	def train(self):
-		""" Trains the classifier after all features are added. """
+	def train(self, counts = None):
+		""" Trains the classifier after all features are added.
+		If counts is given, the CountAccumulator is added to the classes first.
+		"""
+		if counts is not None:
+			self.add_counts(counts)
+		NaiveBayes.train(self)
+		rows = [self.class_data[self.class_indices[i]] for i in range(len(self.classes))]
+		if any(isinstance(row, SparseCounts) for row in rows):
+			counts = self.hashed_counts(rows)
+		else:
+			features = Counter()
+			for c in self.class_data.values():
+				features.update(c)
+			kept = self.prune(features)
+			self.features = feature_index(kept)
+			counts = self.vectorize_batch(rows)
+		self.class_totals = np.asarray(counts.sum(axis=1), dtype=np.float64).ravel()
+		if self.sparse:
+			# Unseen features of a class all have the same log probability. The seen ones
+			# are stored as sparse differences from it.
+			counts = counts.astype(np.float64)
+			totals = np.asarray(counts.sum(axis=1)).ravel()
+			self.class_base = np.log(self.alpha / (totals + self.alpha * len(self.features))).astype(self.dtype)
+			counts.data = np.log((counts.data + self.alpha) / self.alpha)
+			counts.eliminate_zeros()
+			self.class_features = counts.astype(self.dtype)
+			self.updated_rows = {}
+		else:
+			self.class_base = None
+			self.class_features = np.zeros((len(self.classes),len(self.features)+1), dtype=self.dtype)
+			for class_index in range(len(self.classes)):
+				self.class_features[class_index,:] = self.log_prob(counts[class_index].toarray()[0])
+		if not self.keep_counts:
+			self.class_data = None
+			self.doc_freq = None
+
+	def partial_fit(self, class_name, counts, documents = 1):
+		""" Adds documents to a class and updates the trained model in place, without retraining.
+		Unknown classes are added as new classes, and unknown features grow the vocabulary.
+		Only the rows of the updated class are recomputed. When the vocabulary grows, the
+		smoothing denominators of the other classes are rescaled with a vectorized update.
+		The result is the same as adding the counts and calling train() again.
+
+		Parameter counts is a dictionary of features to feature counts, or a 2-tuple
+		of feature id and count arrays, summed over the given number of documents.
+		Requires an unpruned model that keeps its counts.
+		"""
+		if self.min_count is not None or self.min_df is not None or self.top_k is not None or not self.keep_counts:
+			raise ValueError('partial_fit requires an unpruned model that keeps its counts')
+		if class_name not in self.classes:
+			self.add_class(class_name)
+		self.add_documents(class_name, documents)
+		self.add_feature_counts(class_name, counts)
+		if self.class_totals is None: # Not trained yet
+			self.train()
+			return
 		NaiveBayes.train(self)
-		features = Counter()
-		for c in self.class_data.values():
-			features.update(c)
-		self.features = dict(zip(features.keys(), range(0, len(features))))
-		self.class_features = np.zeros((len(self.classes),len(self.features)+1))
-		for (class_name,class_index) in self.classes.items():
-			v = self.vectorize(self.class_data[class_name])
-			self.class_features[class_index,:] = self.log_prob(v)
+		old_len = len(self.features)
+		if isinstance(counts, tuple):
+			ids = np.asarray(counts[0], dtype=np.int64)
+			self.features.add(np.unique(ids[self.features.lookup(ids) < 0]))
+		else:
+			features = list(counts.keys())
+			self.features.add([feature for (feature, column) in zip(features, self.features.lookup(features).tolist()) if column < 0])
+		self.grow_vocabulary(old_len)
+		self.refresh_class(self.classes[class_name])
+
+	def add_class(self, class_name):
+		""" Adds a new class with no documents to the classifier. """
+		class_index = len(self.classes)
+		self.classes[class_name] = class_index
+		self.class_indices[class_index] = class_name
+		self.documents = np.append(self.documents, 0)
+		self.doc_arr = np.append(self.doc_arr, 0)
+		self.class_data[class_name] = Counter()
+		if self.class_totals is None:
+			return
+		self.class_totals = np.append(self.class_totals, 0)
+		if self.sparse:
+			self.class_base = np.append(self.class_base, 0).astype(self.dtype)
+			self.class_features = vstack([self.class_features, csr_matrix((1, self.class_features.shape[1]), dtype=self.dtype)], format='csr')
+		else:
+			self.class_features = np.vstack([self.class_features, np.zeros((1, self.class_features.shape[1]), dtype=self.dtype)])
+
+	def grow_vocabulary(self, old_len):
+		""" Makes room for the features added after the first old_len features.
+		The new features of all classes, like the out-of-vocabulary column, have a count of 0.
+		"""
+		new_len = len(self.features)
+		old_denom = np.log(self.class_totals + self.alpha * old_len)
+		new_denom = np.log(self.class_totals + self.alpha * new_len)
+		if self.sparse:
+			# The differences do not depend on the vocabulary size, only the unseen log probabilities do.
+			self.class_base = (np.log(self.alpha) - new_denom).astype(self.dtype)
+			if new_len > old_len:
+				self.class_features.resize((len(self.classes), new_len+1))
+			return
+		if new_len == old_len:
+			return
+		class_features = np.empty((len(self.classes), new_len+1), dtype=self.dtype)
+		class_features[:,:old_len] = self.class_features[:,:old_len] + (old_denom - new_denom)[:,np.newaxis]
+		class_features[:,old_len:] = (np.log(self.alpha) - new_denom)[:,np.newaxis]
+		self.class_features = class_features
+
+	def refresh_class(self, class_index):
+		""" Recomputes the log probabilities of a single class from its counts. """
+		counts = self.class_data[self.class_indices[class_index]]
+		if isinstance(counts, SparseCounts):
+			counts = counts.arrays()
+		counts = self.vectorize(counts, sparse = True).astype(np.float64)
+		self.class_totals[class_index] = counts.sum()
+		if self.sparse:
+			self.class_base[class_index] = np.log(self.alpha / (self.class_totals[class_index] + self.alpha * len(self.features)))
+			counts.data = np.log((counts.data + self.alpha) / self.alpha)
+			counts.eliminate_zeros()
+			# The row replaces that of the class when the model is used next (see stack_rows).
+			self.updated_rows[class_index] = counts.astype(self.dtype)
+		else:
+			self.class_features[class_index,:] = self.log_prob(counts.toarray()[0])
+
+	def stack_rows(self):
+		""" Puts the rows of the sparse model that partial_fit updated into class_features.
+		Updating a class only replaces its row, so the whole matrix is stacked once when the
+		model is used next, not on every update.
+		"""
+		if len(self.updated_rows) == 0:
+			return
+		parts = []
+		start = 0
+		for (class_index, row) in sorted(self.updated_rows.items()):
+			# The vocabulary may have grown since the row was computed.
+			row.resize((1, self.class_features.shape[1]))
+			parts.extend([self.class_features[start:class_index], row])
+			start = class_index + 1
+		parts.append(self.class_features[start:])
+		self.class_features = vstack(parts, format='csr')
+		self.updated_rows = {}
+
+	def prune(self, features):
+		""" Returns the list of features that are kept according to the pruning options,
+		in the order of the given Counter of total feature counts.
+		"""
+		keep = None
+		if self.min_count is not None:
+			keep = set(feature for (feature, count) in features.items() if count >= self.min_count)
+		if self.min_df is not None:
+			frequent = set(feature for (feature, count) in self.doc_freq.items() if count >= self.min_df)
+			keep = frequent if keep is None else keep & frequent
+		if self.top_k is not None:
+			top = set(feature for c in self.class_data.values() for (feature, count) in c.most_common(self.top_k))
+			keep = top if keep is None else keep & top
+		if keep is None:
+			return list(features.keys())
+		return [feature for feature in features.keys() if feature in keep]
+
+	def hashed_counts(self, rows):
+		""" Builds the vocabulary from the per-class SparseCounts of hashed feature ids
+		(see update_counts), pruned like prune() does, with the features ordered by their ids.
+		Ties of the top_k most frequent features of a class are broken in favor of the lower id.
+
+		Returns the vectorized class-by-feature count matrix (see vectorize_batch), whose last
+		column holds the counts of the pruned features of each class.
+		"""
+		rows = [count_arrays(row) for row in rows]
+		ids, totals = merge_counts(np.concatenate([row_ids for (row_ids, row_counts) in rows]),
+			np.concatenate([row_counts for (row_ids, row_counts) in rows]))
+		keep = totals > 0
+		if self.min_count is not None:
+			keep &= totals >= self.min_count
+		if self.min_df is not None:
+			df_ids, df_counts = count_arrays(self.doc_freq)
+			columns = feature_index(df_ids).lookup(ids)
+			doc_freq = np.zeros((len(ids),), dtype=np.int64)
+			doc_freq[columns >= 0] = df_counts[columns[columns >= 0]]
+			keep &= doc_freq >= self.min_df
+		if self.top_k is not None:
+			top = np.zeros((len(ids),), dtype=bool)
+			for (row_ids, row_counts) in rows:
+				top[np.searchsorted(ids, row_ids[np.argsort(-row_counts, kind='stable')[:self.top_k]])] = True
+			keep &= top
+		self.features = feature_index(ids[keep])
+		return self.vectorize_batch(rows)
+
+	def get_state(self):
+		""" Returns the state of the trained classifier to be saved.
+		The raw feature counts are not saved, so a loaded classifier cannot be updated.
+		"""
+		meta = { 'alpha':self.alpha, 'sparse':self.sparse, 'dtype':np.dtype(self.dtype).str, 'min_count':self.min_count,
+			'min_df':self.min_df, 'top_k':self.top_k }
+		self.stack_rows()
+		# The vocabulary is saved as a FeatureIndex, so that a loaded classifier uses it in place.
+		arrays = { 'class_totals':self.class_totals, 'feature_keys':self.features.sorted_keys,
+			'feature_columns':self.features.columns }
+		if self.sparse:
+			arrays['class_base'] = self.class_base
+			arrays['class_features_data'] = self.class_features.data
+			arrays['class_features_indices'] = self.class_features.indices
+			arrays['class_features_indptr'] = self.class_features.indptr
+		else:
+			arrays['class_features'] = self.class_features
+		return meta, arrays
+
+	def set_state(self, meta, arrays):
+		""" Restores the state returned by get_state(). """
+		self.alpha = meta['alpha']
+		self.sparse = meta['sparse']
+		self.dtype = np.dtype(meta['dtype'])
+		self.min_count = meta['min_count']
+		self.min_df = meta['min_df']
+		self.top_k = meta['top_k']
+		self.keep_counts = False
+		self.class_data = None
+		self.doc_freq = None
+		self.class_totals = arrays['class_totals']
+		self.updated_rows = {}
+		self.features = FeatureIndex(arrays['feature_keys'], arrays['feature_columns'])
+		if self.sparse:
+			self.class_base = arrays['class_base']
+			self.class_features = csr_matrix((arrays['class_features_data'], arrays['class_features_indices'],
+				arrays['class_features_indptr']), shape = (len(self.classes), len(self.features)+1), copy = False)
+		else:
+			self.class_base = None
+			self.class_features = arrays['class_features']
+
+	def select_classes(self, start, stop):
+		""" Returns a copy of the trained classifier that only holds the classes with indices
+		in [start, stop). The vocabulary is shared with this classifier.
+		"""
+		self.stack_rows()
+		model = NaiveBayes.select_classes(self, start, stop)
+		model.class_features = self.class_features[start:stop]
+		model.class_totals = self.class_totals[start:stop]
+		if self.class_base is not None:
+			model.class_base = self.class_base[start:stop]
+		if self.class_data is not None:
+			model.class_data = dict((name, self.class_data[name]) for name in model.classes.keys())
+		return model
 
 	def log_prob(self, v):
 		""" Calculates the log probability of a feature vector.
 		Uses Laplace smoothing with alpha parameter. """
 		return np.log(np.divide(v + self.alpha, np.sum(v) + self.alpha * len(self.features)))
 
-	def vectorize(self, features):
+	def vectorize(self, features, sparse = False):
 		""" Vectorizes the given feature set according to the trained feature set.
 		Any features that are not found in the training set are put into the last index
 		of the feature vector.
 
-		Parameter features is a dictionary of features to feature counts.
+		Parameter features is a dictionary of features to feature counts, or a 2-tuple
+		of feature id and count arrays. If sparse is True, a single row CSR matrix is
+		returned, which only touches the features of the given feature set.
 		"""
-		v = [features[feature] for feature in self.features.keys()]
-		v.append(sum([0 if feature in self.features else fcount for (feature,fcount) in features.items()]))
-		return np.array(v)
+		v = self.sparse_vectorize(features)
+		return v if sparse else v.toarray()[0]
+
+	def vectorize_batch(self, features_list):
+		""" Vectorizes a list of dictionaries of features to feature counts, or 2-tuples of
+		feature id and count arrays, into a CSR matrix with one row per document. The columns
+		of the features of all documents are looked up at once (see FeatureIndex). Any
+		features that are not found in the training set are put into the last column.
+		"""
+		keys = []
+		fcounts = []
+		for features in features_list:
+			if isinstance(features, tuple):
+				keys.append(features[0])
+				fcounts.append(np.asarray(features[1], dtype = np.int64))
+			else:
+				keys.append(list(features.keys()))
+				fcounts.append(np.fromiter(features.values(), dtype = np.int64, count = len(features)))
+		num_rows = len(features_list)
+		lengths = np.array([len(k) for k in keys], dtype = np.int64)
+		if all(isinstance(k, np.ndarray) for k in keys):
+			keys = np.concatenate(keys) if num_rows > 0 else np.zeros((0,), dtype = np.int64)
+		else:
+			keys = [key for k in keys for key in (k.tolist() if isinstance(k, np.ndarray) else k)]
+		fcounts = np.concatenate(fcounts) if num_rows > 0 else np.zeros((0,), dtype = np.int64)
+		columns = self.features.lookup(keys)
+		rows = np.repeat(np.arange(num_rows), lengths)
+		known = columns >= 0
+		oov = np.bincount(rows[~known], weights = fcounts[~known], minlength = num_rows).astype(np.int64)
+		# Each row holds its known features in their given order, followed by the unknown column.
+		indptr = np.concatenate(([0], np.cumsum(np.bincount(rows[known], minlength = num_rows) + 1)))
+		last = indptr[1:] - 1
+		indices = np.empty(indptr[-1], dtype = np.int64)
+		data = np.empty(indptr[-1], dtype = np.int64)
+		inner = np.ones(indptr[-1], dtype = bool)
+		inner[last] = False
+		indices[inner] = columns[known]
+		data[inner] = fcounts[known]
+		indices[last] = len(self.features)
+		data[last] = oov
+		return csr_matrix((data, indices, indptr), shape = (num_rows, len(self.features)+1))
+
+	def sparse_vectorize(self, features):
+		""" Vectorizes the given dictionary of features to feature counts, or 2-tuple of feature id
+		and count arrays, into a single row CSR matrix. Any features that are not found in the
+		training set are put into the last index.
+		"""
+		return MultinomialNaiveBayes.vectorize_batch(self, [features])
 
 	def add_feature_counts(self, class_name, counts):
 		""" Adds the given features to a class.
-		Parameter counts is a dictionary of features to feature counts.
+		Parameter counts is a dictionary of features to feature counts, or a 2-tuple
+		of feature id and count arrays, which are accumulated as SparseCounts (see update_counts).
 		"""
-		self.class_data[class_name] += counts
+		# The counts are added in place, unlike +=, which rebuilds the class counter.
+		self.class_data[class_name] = update_counts(self.class_data[class_name], counts)
+		if self.doc_freq is not None:
+			self.doc_freq = update_doc_freq(self.doc_freq, counts)
+
+	def accumulator(self):
+		""" Returns an empty CountAccumulator that tracks what this classifier needs. """
+		return CountAccumulator(track_df = self.doc_freq is not None)
+
+	def add_counts(self, counts):
+		""" Adds the counts of a CountAccumulator to the classes, in place. """
+		if self.doc_freq is not None and counts.doc_freq is None:
+			raise ValueError('min_df requires an accumulator that tracks document frequencies')
+		for (class_name, class_counts) in counts.class_data.items():
+			self.class_data[class_name] = update_counts(self.class_data[class_name], class_counts)
+		if self.doc_freq is not None:
+			self.doc_freq = update_counts(self.doc_freq, counts.doc_freq)
 
 	def calculate_class_log_probability(self, feature_vec):
-		""" Gets the log probability of a feature vector being in each class. """
+		""" Gets the log probability of a feature vector being in each class.
+		The feature vector can also be a sparse matrix, in which case only its
+		non-zero entries are multiplied.
+		"""
+		if self.class_base is not None:
+			# Sparse model: the unseen log probability for every feature, plus the differences.
+			self.stack_rows()
+			if issparse(feature_vec):
+				probs = np.outer(np.asarray(feature_vec.sum(axis=1)).ravel(), self.class_base) + \
+					np.asarray((feature_vec.dot(self.class_features.T)).todense())
+				return probs[0] if probs.shape[0] == 1 else probs
+			feature_vec = np.asarray(feature_vec)
+			return (np.multiply.outer(feature_vec.sum(axis=-1), self.class_base) + self.class_features.dot(feature_vec.T).T)
+		if issparse(feature_vec):
+			probs = np.asarray(feature_vec.dot(self.class_features.T))
+			return probs[0] if probs.shape[0] == 1 else probs
 		return (self.class_features.dot(feature_vec.T)).T
 
 class BinarizedMultinomialNaiveBayes(MultinomialNaiveBayes):
 	""" Binarized version of the Multinomial Naive Bayes classifier. """
-	def vectorize(self, features):
+	def vectorize(self, features, sparse = False):
 		""" Vectorizes the given feature set according to the trained feature set.
 		Any features that are not found in the training set are put into the last index
 		of the feature vector.
@@ -117,48 +756,141 @@ class BinarizedMultinomialNaiveBayes(MultinomialNaiveBayes):
 		Parameter features is a dictionary of features to feature counts. Since this
 		implementation is binarized, the counts are set to 1 if they are non-zero.
 		"""															
-		v = MultinomialNaiveBayes.vectorize(self,features)
+		v = MultinomialNaiveBayes.vectorize(self,features,sparse)
+		if sparse:
+			v.data = np.minimum(v.data, 1)
+			return v
 		return np.minimum(np.ones(len(v),dtype=np.int),v)
 
+	def vectorize_batch(self, features_list):
+		""" Vectorizes a list of feature sets into a CSR matrix with one row per document,
+		with the counts set to 1 if they are non-zero.
+		"""
+		v = MultinomialNaiveBayes.vectorize_batch(self, features_list)
+		v.data = np.minimum(v.data, 1)
+		return v
+
 class NormalizingNaiveBayes(NaiveBayes):
 	""" A Naive Bayes implementation that tries to fit features into normal distributions.
 	The probability of a feature given a class then becomes the pdf of that feature for each
 	occurance.
+
+	Only the running sufficient statistics of each class and feature are kept (the number of
+	observations, the mean and the sum of squared differences from the mean, updated with
+	Welford's algorithm), so the memory usage does not grow with the number of documents.
 	"""
 	def __init__(self, classes, num_features):
 		""" Initializes the necessary components. """
 		NaiveBayes.__init__(self, classes)
-		self.class_data = {}
-		for class_name in classes:
-			self.class_data[class_name] = [[] for i in range(num_features)]
+		self.num_features = num_features
+		self.counts = np.zeros((len(classes),))
+		self.means = np.zeros((len(classes), num_features))
+		self.sq_diffs = np.zeros((len(classes), num_features))
 		self.feature_means = None
 		self.feature_stddevs = None
-		self.num_features = num_features
+		self.log_norms = None
+		self.inv_vars = None
 
 	def add_features(self, class_name, features):
 		""" Adds a realization of a feature set to a class. """
-		for i in range(self.num_features):
-			self.class_data[class_name][i].append(features[i])
-
-	def fit(self, features):
-		""" Fits each of the given tuple of features to a normal distribution. """
-		return [norm.fit(feature) for feature in features]
+		i = self.classes[class_name]
+		self.counts[i] += 1
+		delta = np.asarray(features, dtype=np.float64) - self.means[i]
+		self.means[i] += delta / self.counts[i]
+		self.sq_diffs[i] += delta * (np.asarray(features, dtype=np.float64) - self.means[i])
 
 	def vectorize(self, features):
 		""" Vectorizes the tuple of features. """
 		return np.array([features[0],np.mean(features[1]),np.mean(features[2]),np.mean(features[3]),np.mean(features[4]),np.mean(features[5]),np.mean(features[6]),features[7]])
 
 	def train(self):
-		""" Trains the naive bayes classifier. """
+		""" Trains the naive bayes classifier.
+		The standard deviations are the maximum likelihood estimates, as given by norm.fit.
+		The parts of the log pdfs that do not depend on the features are computed here.
+		"""
 		NaiveBayes.train(self)
-		features = np.array([(lambda x: self.fit(self.class_data[x]))(class_name) for class_name in self.classes.keys()])
-		self.feature_means = np.matrix(features[:,:,0])
-		self.feature_stddevs = np.matrix(features[:,:,1])
+		with np.errstate(divide='ignore', invalid='ignore'):
+			self.feature_means = self.means.copy()
+			self.feature_stddevs = np.sqrt(self.sq_diffs / self.counts[:,np.newaxis])
+			self.set_log_pdf_terms()
+
+	def set_log_pdf_terms(self):
+		""" Computes the normalizing terms and the inverse variances of the log pdfs.
+		Features with a standard deviation of 0 get a nan normalizing term, so that
+		they are ignored while scoring, like their nan pdfs were before.
+		"""
+		stddevs = np.where(self.feature_stddevs > 0, self.feature_stddevs, np.nan)
+		self.log_norms = -0.5 * np.log(2 * np.pi) - np.log(stddevs)
+		self.inv_vars = 1 / (stddevs ** 2)
+
+	def get_state(self):
+		""" Returns the state of the trained classifier to be saved. """
+		return { 'num_features':self.num_features }, { 'counts':self.counts, 'means':self.means,
+			'sq_diffs':self.sq_diffs, 'feature_means':self.feature_means, 'feature_stddevs':self.feature_stddevs }
+
+	def set_state(self, meta, arrays):
+		""" Restores the state returned by get_state(). """
+		self.num_features = meta['num_features']
+		self.counts = arrays['counts']
+		self.means = arrays['means']
+		self.sq_diffs = arrays['sq_diffs']
+		self.feature_means = arrays['feature_means']
+		self.feature_stddevs = arrays['feature_stddevs']
+		with np.errstate(divide='ignore', invalid='ignore'):
+			self.set_log_pdf_terms()
+
+	def select_classes(self, start, stop):
+		""" Returns a copy of the trained classifier that only holds the classes with indices
+		in [start, stop).
+		"""
+		model = NaiveBayes.select_classes(self, start, stop)
+		for name in ('counts', 'means', 'sq_diffs', 'feature_means', 'feature_stddevs', 'log_norms', 'inv_vars'):
+			setattr(model, name, getattr(self, name)[start:stop])
+		return model
 
 	def calculate_class_log_probability(self, feature_vec):
-		""" Gets the log probability of the feature vector for each class """
-		p = norm.pdf(feature_vec, self.feature_means, self.feature_stddevs)
-		return np.nansum(np.log(p),axis = 1)
+		""" Gets the log probability of the feature vector for each class.
+		The closed form of the normal log pdf is used, so it does not underflow.
+		A matrix of feature vectors gives one row of log probabilities per document.
+		"""
+		feature_vec = np.asarray(feature_vec, dtype=np.float64)
+		diff = feature_vec[...,np.newaxis,:] - self.feature_means
+		with np.errstate(invalid='ignore'):
+			return np.nansum(self.log_norms - 0.5 * diff * diff * self.inv_vars, axis = -1)
+
+# The classifiers that load() can restore, by the type names that save() writes.
+model_types = dict((model_type.__name__, model_type) for model_type in
+	(MultinomialNaiveBayes, BinarizedMultinomialNaiveBayes, NormalizingNaiveBayes))
+
+def load(path):
+	""" Loads a classifier saved by NaiveBayes.save().
+	The arrays are memory-mapped read-only, so loading is fast and processes that load
+	the same file share a single copy of the weights.
+
+	Returns the classifier.
+	"""
+	with open(path, 'rb') as f:
+		buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+	magic, header_len = model_header.unpack_from(buf, 0)
+	if magic != model_magic:
+		raise ValueError('Not a saved Naive Bayes model: ' + path)
+	meta = json.loads(buf[model_header.size:model_header.size+header_len].decode('utf-8'))
+	data_offset = -(-(model_header.size + header_len) // model_alignment) * model_alignment
+	arrays = {}
+	for (name, info) in meta['arrays'].items():
+		dtype = np.dtype(info['dtype'])
+		count = int(np.prod(info['shape'], dtype=np.int64))
+		arrays[name] = np.frombuffer(buf, dtype = dtype, count = count, offset = data_offset + info['offset']).reshape(info['shape'])
+	name = meta.get('type')
+	if not isinstance(name, str) or name not in model_types:
+		raise ValueError('Unknown model type: ' + repr(name))
+	model_type = model_types[name]
+	model = model_type.__new__(model_type)
+	NaiveBayes.__init__(model, meta['classes'])
+	model.documents = arrays['documents']
+	model.doc_arr = arrays['doc_arr']
+	model.set_state(meta, arrays)
+	return model
 
 if __name__ == '__main__':
 	""" Performs the basic example from the lecture notes. """
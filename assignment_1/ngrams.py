@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+from collections import Counter
+import numpy as np
+import sys
+
+# Multiplier of the polynomial rolling hash over the code points of an n-gram.
+hash_base = np.uint64(1000003)
+# Multiplier of the final mixing step, so that nearby hashes spread over the buckets.
+hash_mix = np.uint64(0x9E3779B97F4A7C15)
+# Tokens are joined with this character, which cannot be a part of a token.
+separator = '\0'
+
+def hashed_ngrams(tokens, ns, num_buckets):
+	""" Returns the hashed char n-gram ids of all given n values for a list of tokens.
+	The tokens are joined into a single array of code points and the n-grams are hashed
+	in a vectorized fashion, without building any n-gram strings. N-grams that cross
+	token boundaries are dropped. The hash is stable between processes.
+	"""
+	if len(tokens) == 0:
+		return np.zeros((0,), dtype=np.int64)
+	text = separator.join(tokens)
+	cp = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+	sep = cp == 0
+	ids = []
+	with np.errstate(over='ignore'):
+		for n in ns:
+			m = len(cp) - n + 1
+			if m <= 0:
+				continue
+			h = np.zeros((m,), dtype=np.uint64)
+			crosses = np.zeros((m,), dtype=bool)
+			for j in range(n):
+				h = h * hash_base + cp[j:j+m]
+				crosses |= sep[j:j+m]
+			# Mix in n, so that the same code points of different lengths differ.
+			h = (h[~crosses] * hash_base + np.uint64(n)) * hash_mix
+			ids.append((h >> np.uint64(32)) % np.uint64(num_buckets))
+	if len(ids) == 0:
+		return np.zeros((0,), dtype=np.int64)
+	return np.concatenate(ids).astype(np.int64)
+
+def merge_counts(ids, counts):
+	""" Sums the counts of the same ids.
+
+	Returns the sorted unique ids and their counts as a 2-tuple of arrays.
+	"""
+	unique_ids, inverse = np.unique(ids, return_inverse=True)
+	return unique_ids, np.bincount(inverse, weights=counts, minlength=len(unique_ids)).astype(np.int64)
+
+class CharNgrams:
+	""" Character n-gram extractor for several n values at once.
+	If num_buckets is given, the n-grams are hashed into the integer range [0, num_buckets)
+	(the hashing trick) and the bags are represented by a 2-tuple of id and count arrays.
+	Otherwise, the bags are Counters of n-gram strings.
+	"""
+	def __init__(self, ns = 5, num_buckets = None, buffer_size = 8192):
+		""" Initializes the extractor with an n value or a list of n values.
+		Buffer size is the number of tokens that are hashed together.
+		"""
+		self.ns = tuple(ns) if hasattr(ns, '__iter__') else (ns,)
+		self.num_buckets = num_buckets
+		self.buffer_size = buffer_size
+
+	def hashed(self):
+		""" Returns True if the n-grams are hashed. """
+		return self.num_buckets is not None
+
+	def bag(self, tokens):
+		""" Returns the bag of char n-grams of the given tokens. """
+		acc = self.accumulator()
+		acc.add(tokens)
+		return acc.result()
+
+	def accumulator(self):
+		""" Returns an accumulator that builds a bag of char n-grams incrementally. """
+		return HashedNgramAccumulator(self) if self.hashed() else NgramAccumulator(self)
+
+class NgramAccumulator:
+	""" Accumulates n-gram strings into a Counter. """
+	def __init__(self, extractor):
+		self.ns = extractor.ns
+		self.counts = Counter()
+
+	def add(self, tokens):
+		""" Adds the n-grams of the given tokens. """
+		for n in self.ns:
+			self.counts.update(token[i:i+n] for token in tokens for i in range(len(token)-n+1))
+
+	def result(self):
+		""" Returns the Counter of n-grams. """
+		return self.counts
+
+class HashedNgramAccumulator:
+	""" Accumulates hashed n-gram ids into compact id and count arrays.
+	Tokens are buffered so that they are hashed in large vectorized batches.
+	"""
+	def __init__(self, extractor):
+		self.extractor = extractor
+		self.buffer = []
+		self.ids = np.zeros((0,), dtype=np.int64)
+		self.counts = np.zeros((0,), dtype=np.int64)
+
+	def add(self, tokens):
+		""" Adds the n-grams of the given tokens. """
+		self.buffer.extend(tokens)
+		if len(self.buffer) >= self.extractor.buffer_size:
+			self.flush()
+
+	def flush(self):
+		""" Hashes the buffered tokens and merges them with the existing counts. """
+		if len(self.buffer) == 0:
+			return
+		ids = hashed_ngrams(self.buffer, self.extractor.ns, self.extractor.num_buckets)
+		self.buffer = []
+		self.ids, self.counts = merge_counts(np.concatenate((self.ids, ids)),
+			np.concatenate((self.counts, np.ones(len(ids), dtype=np.int64))))
+
+	def result(self):
+		""" Returns the 2-tuple of sorted unique ids and their counts. """
+		self.flush()
+		return self.ids, self.counts
+
+if __name__ == '__main__':
+	""" Accepts a text to extract the hashed char 3, 4 and 5-grams of. """
+	if len(sys.argv) < 2:
+		print('Please enter a text.')
+	else:
+		print(CharNgrams((3, 4, 5), num_buckets = 2 ** 20).bag(sys.argv[1].split()))
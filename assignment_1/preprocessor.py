@@ -5,12 +5,14 @@ import random
 import sys
 import shutil
 import getopt
+import json
 
 class Preprocessor:
 	def __init__(self):
 		self.training_path = ''
 		self.test_path = ''
 		self.authors = {}
+		self.manifest = None
 
 	def organize_dataset(self, seed, path, ratio = 0.6, training_path = None, test_path = None):
 		""" Generates training and test datasets for each author.
@@ -25,25 +27,94 @@ class Preprocessor:
 
 		Returns the training and test paths.
 		"""
-		if seed is not None:
-			random.seed(seed)
 		path = os.path.normpath(path)
 		self.training_path = path + '__training' if training_path is None else os.path.normpath(training_path)
 		self.test_path = path + '__test' if test_path is None else os.path.normpath(test_path)
 		self.init_dirs(self.training_path, self.test_path)
-		authors = os.listdir(path)
-		for author in authors:
-			texts = os.listdir(os.path.join(path, author))
+		for (author, texts) in self.split_dataset(seed, path, ratio).items():
 			os.makedirs(os.path.join(self.training_path, author), exist_ok=True)
 			os.makedirs(os.path.join(self.test_path, author), exist_ok=True)
-			random.shuffle(texts)
-			train_size = math.floor(ratio*len(texts))
-			for text in texts[0:train_size]:
+			for text in texts['training']:
 				shutil.copyfile(os.path.join(path, author, text), os.path.join(self.training_path, author, text))
-			for text in texts[train_size:]:
+			for text in texts['test']:
 				shutil.copyfile(os.path.join(path, author, text), os.path.join(self.test_path, author, text))
 		return self.training_path, self.test_path
 
+	def split_dataset(self, seed, path, ratio = 0.6):
+		""" Splits the texts of each author into training and test sets without copying them.
+		The texts are shuffled in the same way as organize_dataset().
+
+		Returns a dictionary of authors to dictionaries of 'training' and 'test' file name lists.
+		"""
+		if seed is not None:
+			random.seed(seed)
+		authors = {}
+		for author in os.listdir(path):
+			texts = os.listdir(os.path.join(path, author))
+			random.shuffle(texts)
+			train_size = math.floor(ratio*len(texts))
+			authors[author] = { 'training':texts[0:train_size], 'test':texts[train_size:] }
+		return authors
+
+	def create_manifest(self, seed, path, ratio = 0.6, manifest_path = None):
+		""" Generates the training and test datasets for each author as a manifest.
+		Works like organize_dataset(), but instead of copying the texts, writes a manifest
+		file that refers to them in the dataset directory. The seed and the ratio are
+		recorded in the manifest. The default manifest path is the dataset path
+		followed by '__manifest.json'.
+
+		Returns the manifest path.
+		"""
+		path = os.path.normpath(path)
+		manifest_path = path + '__manifest.json' if manifest_path is None else manifest_path
+		self.save_manifest(manifest_path, { 'dataset':os.path.abspath(path), 'seed':seed, 'ratio':ratio,
+			'authors':self.split_dataset(seed, path, ratio) })
+		return manifest_path
+
+	def create_kfold_manifests(self, seed, path, k = 10, manifest_path = None):
+		""" Generates stratified k-fold splits of the dataset as k manifests.
+		The texts of each author are shuffled and dealt into k folds, so that each
+		author is equally represented in each fold. The i'th manifest uses the i'th fold
+		as its test set and the rest as its training set. The default manifest paths are
+		the dataset path followed by '__fold_i.json'. If manifest_path is given, it must
+		contain a {} to be replaced with the fold index.
+
+		Returns the list of manifest paths.
+		"""
+		if seed is not None:
+			random.seed(seed)
+		path = os.path.normpath(path)
+		manifest_path = path + '__fold_{}.json' if manifest_path is None else manifest_path
+		folds = [{} for i in range(k)]
+		for author in os.listdir(path):
+			texts = os.listdir(os.path.join(path, author))
+			random.shuffle(texts)
+			for i in range(k):
+				folds[i][author] = texts[i::k]
+		paths = []
+		for i in range(k):
+			authors = dict((author, { 'training':[text for j in range(k) if j != i for text in folds[j][author]],
+				'test':folds[i][author] }) for author in folds[i].keys())
+			paths.append(manifest_path.format(i))
+			self.save_manifest(paths[-1], { 'dataset':os.path.abspath(path), 'seed':seed, 'folds':k, 'fold':i,
+				'authors':authors })
+		return paths
+
+	def save_manifest(self, manifest_path, manifest):
+		""" Writes a manifest to the given path. """
+		with open(manifest_path, 'w', encoding = 'utf-8') as f:
+			json.dump(manifest, f, ensure_ascii=False)
+
+	def load_manifest(self, manifest_path):
+		""" Generates the internal representation of training and test sets from a manifest.
+		Afterwards, the file paths refer to the texts in the original dataset directory.
+		"""
+		with open(manifest_path, 'r', encoding = 'utf-8') as f:
+			self.manifest = json.load(f)
+		self.training_path = self.manifest['dataset']
+		self.test_path = self.manifest['dataset']
+		self.authors = self.manifest['authors']
+
 	def init_dirs(self, training_path, test_path):
 		""" Initializes the training and test directories from scratch. """
 		shutil.rmtree(training_path, ignore_errors=True)
@@ -51,12 +122,16 @@ class Preprocessor:
 		os.makedirs(training_path, exist_ok=True)
 		os.makedirs(test_path, exist_ok=True)
 
-	def organize_authors(self, training_path = None, test_path = None):
+	def organize_authors(self, training_path = None, test_path = None, manifest_path = None):
 		""" Generates the internal representation of training and test sets for each author.
 		If training and test paths are set (ex: as a result of calling organize_dataset()),
 		their arguments are not necessary. Authors that do not have any training data
-		are automatically ignored.
+		are automatically ignored. If a manifest path is given, the sets are read from
+		the manifest instead (see load_manifest()).
 		"""
+		if manifest_path is not None:
+			self.load_manifest(manifest_path)
+			return
 		if training_path is not None and test_path is not None:
 			self.training_path = training_path
 			self.test_path = test_path
@@ -100,12 +175,19 @@ if __name__ == '__main__':
 	If used, the -s option followed by a number can also be used to set the random seed
 	for test data shuffling. If only one directory path is given, it is assumed to be of the
 	dataset and training and test folders will be generated automatically.
+
+	If the -m option is used, nothing is copied. Instead, a manifest of the split is written
+	to the path given as the second argument (or next to the dataset, if omitted). If the
+	-k option followed by a number is used, that many stratified k-fold manifests are written
+	instead, in which case the optional second argument must contain a {} for the fold index.
 	"""
 	seed = None
+	manifest = False
+	folds = None
 	argv = []
 	p = Preprocessor()
 	try:
-		optlist, argv = getopt.getopt(sys.argv[1:], 's:', ["seed="])
+		optlist, argv = getopt.getopt(sys.argv[1:], 's:mk:', ["seed=", "manifest", "folds="])
 	except getopt.GetoptError as err:
 		# print help information and exit:
 		print(err) # will print something like "option -a not recognized"
@@ -114,11 +196,23 @@ if __name__ == '__main__':
 	for o, a in optlist:
 		if o in ("-s","--seed"):
 			seed = a
+		elif o in ("-m","--manifest"):
+			manifest = True
+		elif o in ("-k","--folds"):
+			manifest = True
+			folds = int(a)
 		else:
 			assert False, "unhandled option"
 
 	if len(argv) < 1:
 		print('Please enter at least the directory of the dataset')
+	elif folds is not None:
+		p = Preprocessor()
+		for path in p.create_kfold_manifests(seed, argv[0], folds, manifest_path = argv[1] if len(argv) > 1 else None):
+			print('Manifest path:',path)
+	elif manifest:
+		p = Preprocessor()
+		print('Manifest path:',p.create_manifest(seed, argv[0], manifest_path = argv[1] if len(argv) > 1 else None))
 	elif len(argv) < 3:
 		p = Preprocessor()
 		tra, tes = p.organize_dataset(seed, argv[0])
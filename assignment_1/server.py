@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+from tokenizer import Tokenizer
+from tester import model_path
+from sharded import ShardedClassifier
+import naive_bayes
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque
+import socketserver
+import signal
+import threading
+import queue
+import json
+import time
+import numpy as np
+import getopt
+import os
+import sys
+
+feature_sets = ['words', 'ngrams', 'set', 'complexity']
+
+class Request:
+	""" A single document waiting to be classified. Start is the time the document was received. """
+	def __init__(self, features, start):
+		self.features = features
+		self.start = start
+		self.done = threading.Event()
+		self.author = None
+		self.score = None
+		self.error = None
+
+class ClassificationService:
+	""" Classifies documents with a trained classifier, which is loaded once.
+	The documents are tokenized by the threads that receive them, and a single batching thread
+	coalesces the waiting documents into micro-batches, which are classified in a single matrix
+	multiplication. A batch is closed when it has max_batch documents, or max_wait seconds after
+	its first document arrived.
+
+	The feature set is one of 'words', 'ngrams', 'set' and 'complexity', as in test_authors,
+	and ngram_len and num_buckets must be the ones the classifier was trained with.
+	"""
+	def __init__(self, classifier, feature_set = 'words', ngram_len = 5, num_buckets = None, max_batch = 64,
+		max_wait = 0.002, window = 10000):
+		""" Initializes the service with a trained classifier. Window is the number of most recent
+		requests the latency percentiles are computed over.
+		"""
+		self.classifier = classifier
+		self.feature_ind = (0, 1, 0, 2)[feature_sets.index(feature_set)]
+		self.ngram_len = ngram_len if feature_set == 'ngrams' else None
+		self.num_buckets = num_buckets
+		self.max_batch = max_batch
+		self.max_wait = max_wait
+		self.queue = queue.Queue()
+		self.latencies = deque(maxlen = window)
+		self.batch_sizes = deque(maxlen = window)
+		self.requests = 0
+		self.start = time.perf_counter()
+		self.lock = threading.Lock()
+		self.thread = threading.Thread(target = self.run, daemon = True)
+		self.thread.start()
+
+	def featurize(self, text):
+		""" Extracts the features of a document given as Windows-1254 (Turkish) encoded bytes,
+		through the same Tokenizer path as the tester.
+		"""
+		t = Tokenizer(buffer = text)
+		return t.extract(self.feature_ind == 0, self.ngram_len, self.feature_ind == 2, self.num_buckets)[self.feature_ind]
+
+	def classify(self, text):
+		""" Classifies a document given as Windows-1254 (Turkish) encoded bytes.
+		Blocks until the batch of the document is classified.
+
+		Returns a 2-tuple of the predicted class and its log probability score.
+		"""
+		start = time.perf_counter()
+		return self.classify_features(self.featurize(text), start)
+
+	def classify_features(self, features, start):
+		""" Classifies the features of a document, which was received at the given time.
+		The latency of the document is measured from then, so it includes the tokenization.
+		If the batch of the document could not be classified, its exception is raised.
+
+		Returns a 2-tuple of the predicted class and its log probability score.
+		"""
+		request = Request(features, start)
+		self.queue.put(request)
+		request.done.wait()
+		if request.error is not None:
+			raise request.error
+		return request.author, request.score
+
+	def reply(self, text):
+		""" Classifies a document given as Windows-1254 (Turkish) encoded bytes for a handler.
+		Documents that cannot be tokenized are answered with 400, and documents whose batch
+		failed with 500, with the error in the reply.
+
+		Returns a 2-tuple of the HTTP status code and the JSON serializable reply.
+		"""
+		start = time.perf_counter()
+		try:
+			features = self.featurize(text)
+		except Exception as err:
+			return 400, { 'error':'Could not tokenize the document: {}: {}'.format(type(err).__name__, err) }
+		try:
+			author, score = self.classify_features(features, start)
+		except Exception as err:
+			return 500, { 'error':'Could not classify the document: {}: {}'.format(type(err).__name__, err) }
+		return 200, { 'author':author, 'score':score }
+
+	def next_batch(self):
+		""" Waits for a request and collects the requests that arrive until the batch is closed. """
+		batch = [self.queue.get()]
+		deadline = time.perf_counter() + self.max_wait
+		while len(batch) < self.max_batch:
+			timeout = deadline - time.perf_counter()
+			try:
+				batch.append(self.queue.get_nowait() if timeout <= 0 else self.queue.get(timeout = timeout))
+			except queue.Empty:
+				break
+		return batch
+
+	def run(self):
+		""" Classifies the micro-batches until the process exits.
+		If a batch fails, its exception is given to each of its requests, and the thread goes on.
+		"""
+		while True:
+			batch = self.next_batch()
+			try:
+				with np.errstate(divide='ignore', invalid='ignore'):
+					indices, scores = self.classifier.predict_batch(self.classifier.vectorize_batch([request.features for request in batch]))
+				end = time.perf_counter()
+				with self.lock:
+					for (request, index, score) in zip(batch, indices.tolist(), scores.tolist()):
+						request.author = self.classifier.class_indices[index]
+						request.score = score
+						self.latencies.append(end - request.start)
+					self.batch_sizes.append(len(batch))
+					self.requests += len(batch)
+			except Exception as err:
+				for request in batch:
+					request.error = err
+			finally:
+				for request in batch:
+					request.done.set()
+
+	def stats(self):
+		""" Returns a dictionary of the number of classified documents, the throughput in documents
+		per second since the start, the mean batch size and the p50 and p99 latencies in milliseconds.
+		"""
+		with self.lock:
+			latencies = np.array(self.latencies) * 1000
+			batch_sizes = np.array(self.batch_sizes)
+			requests = self.requests
+		elapsed = time.perf_counter() - self.start
+		return { 'requests':requests, 'throughput':requests / elapsed,
+			'mean_batch':float(batch_sizes.mean()) if len(batch_sizes) > 0 else None,
+			'p50_ms':float(np.percentile(latencies, 50)) if len(latencies) > 0 else None,
+			'p99_ms':float(np.percentile(latencies, 99)) if len(latencies) > 0 else None }
+
+class UnixRequestHandler(socketserver.StreamRequestHandler):
+	""" Reads a document until the client shuts down its side of the connection, and replies with
+	a JSON line of the predicted author and score, or of the error. An empty document is answered
+	with the stats.
+	"""
+	def handle(self):
+		text = self.rfile.read()
+		if len(text) == 0:
+			reply = self.server.service.stats()
+		else:
+			status, reply = self.server.service.reply(text)
+		self.wfile.write(json.dumps(reply, ensure_ascii=False).encode('utf-8') + b'\n')
+
+class HTTPRequestHandler(BaseHTTPRequestHandler):
+	""" Classifies the body of a POST request to /classify, and returns the stats on GET /stats.
+	The replies are JSON objects. Errors are replied with 400 or 500 and a JSON object of the error.
+	"""
+	def do_POST(self):
+		if self.path != '/classify':
+			self.send_error(404)
+			return
+		text = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		self.reply(*self.server.service.reply(text))
+
+	def do_GET(self):
+		if self.path != '/stats':
+			self.send_error(404)
+			return
+		self.reply(200, self.server.service.stats())
+
+	def reply(self, status, obj):
+		body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+# The listen backlog of the servers. The default of socketserver (5) resets the connections
+# of bursts of concurrent clients before the server gets to accept them.
+default_backlog = 128
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+	request_queue_size = default_backlog
+
+class HTTPServer(ThreadingHTTPServer):
+	daemon_threads = True
+	request_queue_size = default_backlog
+
+def serve(service, socket_path = None, port = None, host = '127.0.0.1', backlog = default_backlog):
+	""" Serves the service over a Unix socket at socket_path, or over HTTP on the given port.
+	Backlog is the number of pending connections the socket queues before refusing new ones.
+	"""
+	if socket_path is not None:
+		if os.path.exists(socket_path):
+			os.remove(socket_path)
+		server = UnixServer(socket_path, UnixRequestHandler, bind_and_activate = False)
+	else:
+		server = HTTPServer((host, port), HTTPRequestHandler, bind_and_activate = False)
+	server.request_queue_size = backlog
+	try:
+		server.server_bind()
+		server.server_activate()
+	except OSError:
+		server.server_close()
+		raise
+	server.service = service
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+		if socket_path is not None:
+			os.remove(socket_path)
+
+if __name__ == '__main__':
+	""" Accepts a model path prefix, as given to the -o option of tester.py. The -f option followed by
+	one of words, ngrams, set and complexity selects the classifier of that feature set (words by default).
+	The -n option followed by a number sets the n-gram length, and the -b option followed by a number
+	sets the number of hash buckets of the n-grams, which must match the trained classifier. The -u option
+	followed by a path serves over a Unix socket at that path, and the -p option followed by a number serves
+	over HTTP on that port. The -s option followed by a number sets the maximum batch size, and the -w option
+	followed by a number of milliseconds sets the maximum time a batch waits for more documents. The -r
+	option followed by a number splits the classes of the classifier across that many worker processes
+	(see sharded.py). The -q option followed by a number sets the number of pending connections that are
+	queued before new ones are refused (128 by default).
+
+	Documents are sent as raw Windows-1254 (Turkish) encoded bytes, like the dataset files. Over the Unix
+	socket, the client shuts down writing after the document and an empty document returns the stats. Over
+	HTTP, documents are POSTed to /classify and the stats are at /stats. The stats are also printed on exit.
+	"""
+	feature_set = 'words'
+	ngram_len = 5
+	num_buckets = None
+	socket_path = None
+	port = None
+	max_batch = 64
+	max_wait = 2
+	num_shards = 1
+	backlog = default_backlog
+	try:
+		optlist, argv = getopt.getopt(sys.argv[1:], 'f:n:b:u:p:s:w:r:q:', ["features=", "ngrams=", "buckets=", "socket=", "port=",
+			"batch=", "wait=", "shards=", "backlog="])
+	except getopt.GetoptError as err:
+		print(err)
+		sys.exit(2)
+	for o, a in optlist:
+		if o in ("-f","--features"):
+			feature_set = a
+		elif o in ("-n","--ngrams"):
+			ngram_len = int(a)
+		elif o in ("-b","--buckets"):
+			num_buckets = int(a)
+		elif o in ("-u","--socket"):
+			socket_path = a
+		elif o in ("-p","--port"):
+			port = int(a)
+		elif o in ("-s","--batch"):
+			max_batch = int(a)
+		elif o in ("-w","--wait"):
+			max_wait = float(a)
+		elif o in ("-r","--shards"):
+			num_shards = int(a)
+		elif o in ("-q","--backlog"):
+			backlog = int(a)
+		else:
+			assert False, "unhandled option"
+
+	if len(argv) < 1 or feature_set not in feature_sets or (socket_path is None) == (port is None):
+		print('Please enter the model path prefix, a feature set, and either a socket path or a port.')
+		sys.exit(2)
+	path = model_path(argv[0], feature_sets.index(feature_set))
+	classifier = ShardedClassifier(path, num_shards) if num_shards > 1 else naive_bayes.load(path)
+	service = ClassificationService(classifier, feature_set, ngram_len, num_buckets, max_batch, max_wait / 1000)
+	# Terminating the server also removes the socket and prints the stats.
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	try:
+		serve(service, socket_path, port, backlog = backlog)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		print(json.dumps(service.stats()))
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+from tokenizer import Tokenizer
+import naive_bayes
+from multiprocessing import Process, Pipe
+import numpy as np
+import sys
+
+def top_k(probs, k, offset = 0):
+	""" Returns the k highest log probabilities of each row of a matrix, highest first.
+	Ties are broken in favor of the lower class index, like np.argmax does.
+	Offset is added to the class indices.
+
+	Returns a 2-tuple of the class index and the log probability matrices, with one
+	row per document and min(k, number of classes) columns.
+	"""
+	num_docs, num_classes = probs.shape
+	k = min(k, num_classes)
+	indices = np.empty((num_docs, k), dtype=np.int64)
+	scores = np.empty((num_docs, k))
+	for row in range(num_docs):
+		p = probs[row]
+		# Every class that ties with the k'th highest one is a candidate, so the ties can be broken exactly.
+		threshold = p[np.argpartition(-p, k-1)[k-1]] if k < num_classes else -np.inf
+		candidates = np.flatnonzero(p >= threshold)
+		order = candidates[np.lexsort((candidates, -p[candidates]))][:k]
+		indices[row] = order + offset
+		scores[row] = p[order]
+	return indices, scores
+
+def merge_top_k(indices, scores, k):
+	""" Merges the top k lists of several shards, which are concatenated along the columns in
+	the order of their class ranges. Since a stable sort keeps tied classes in column order,
+	ties are still broken in favor of the lower class index.
+
+	Returns a 2-tuple of the class index and the log probability matrices of the global top k.
+	"""
+	order = np.argsort(-scores, axis=1, kind='stable')[:,:k]
+	rows = np.arange(scores.shape[0])[:,np.newaxis]
+	return indices[rows, order], scores[rows, order]
+
+def shard_worker(conn, model, start, stop):
+	""" Serves the queries of a single shard until it receives None.
+	Model is a trained classifier or the path of a saved one, of which only the
+	classes with indices in [start, stop) are kept.
+	"""
+	if isinstance(model, str):
+		model = naive_bayes.load(model)
+	shard = model.select_classes(start, stop)
+	del model
+	while True:
+		query = conn.recv()
+		if query is None:
+			break
+		feature_mat, k = query
+		with np.errstate(divide='ignore', invalid='ignore'):
+			conn.send(top_k(shard.log_proba_batch(feature_mat), k, start))
+	conn.close()
+
+class ShardedClassifier:
+	""" Scatter-gather scoring of a trained classifier whose classes are split across worker processes.
+	Each worker holds the slice of the class log probability tables and class base probabilities of
+	its classes. The feature vectors of a query are vectorized once, sent to every shard, and the top
+	k classes of each shard are merged into the exact global top k, so the predictions are the same as
+	those of the unsharded classifier.
+
+	The classifier can be given as a trained classifier or as the path of a saved one. If a path is
+	given, every worker memory-maps the saved file and only its own slice is ever read.
+	"""
+	def __init__(self, model, num_shards = 2):
+		""" Starts a worker process for each of the num_shards shards. The classes are split
+		into contiguous ranges of (almost) equal size.
+		"""
+		self.model = naive_bayes.load(model) if isinstance(model, str) else model
+		self.classes = self.model.classes
+		self.class_indices = self.model.class_indices
+		bounds = np.linspace(0, len(self.classes), min(num_shards, len(self.classes)) + 1).astype(np.int64).tolist()
+		self.connections = []
+		self.workers = []
+		for (start, stop) in zip(bounds[:-1], bounds[1:]):
+			conn, worker_conn = Pipe()
+			worker = Process(target = shard_worker, args = (worker_conn, model, start, stop), daemon = True)
+			worker.start()
+			worker_conn.close()
+			self.connections.append(conn)
+			self.workers.append(worker)
+
+	def get_classes(self):
+		""" Convenience method for getting classes and their indexes. """
+		return self.classes
+
+	def vectorize(self, features):
+		""" Vectorizes the given feature set according to the trained feature set. """
+		return self.model.vectorize(features)
+
+	def vectorize_batch(self, features_list):
+		""" Vectorizes a list of feature sets into a matrix with one row per document. """
+		return self.model.vectorize_batch(features_list)
+
+	def top_k(self, feature_mat, k = 1):
+		""" Scores a matrix of feature vectors on all shards and merges their results.
+
+		Returns a 2-tuple of the class index and the log probability matrices of the top k classes,
+		with one row per document, highest first.
+		"""
+		for conn in self.connections:
+			conn.send((feature_mat, k))
+		results = [conn.recv() for conn in self.connections]
+		return merge_top_k(np.hstack([indices for (indices, scores) in results]),
+			np.hstack([scores for (indices, scores) in results]), k)
+
+	def predict_batch(self, feature_mat):
+		""" Returns the most probable classes for a matrix of feature vectors.
+
+		Returns a 2-tuple of the array of class indices (see self.class_indices) and
+		the array of their log probabilities.
+		"""
+		indices, scores = self.top_k(feature_mat, 1)
+		return indices[:,0], scores[:,0]
+
+	def most_probable_class(self, feature_vec):
+		""" Returns the class with the highest log probability, given the feature vector. """
+		indices, scores = self.top_k(np.asarray(feature_vec)[np.newaxis], 1)
+		return self.class_indices[int(indices[0,0])]
+
+	def close(self):
+		""" Stops the worker processes. """
+		for conn in self.connections:
+			conn.send(None)
+			conn.close()
+		for worker in self.workers:
+			worker.join()
+		self.connections = []
+		self.workers = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+if __name__ == '__main__':
+	""" Accepts the path of a bag of words classifier saved by tester.py, the number of shards,
+	the number of classes to rank and the paths of the texts to classify. Prints the top ranked
+	classes of each text.
+	"""
+	if len(sys.argv) < 5:
+		print('Please enter the classifier path, the number of shards, the number of classes to rank and the text paths.')
+		sys.exit(2)
+	with ShardedClassifier(sys.argv[1], int(sys.argv[2])) as clsf:
+		indices, scores = clsf.top_k(clsf.vectorize_batch([Tokenizer(path).bag_of_words() for path in sys.argv[4:]]), int(sys.argv[3]))
+		for (path, row, row_scores) in zip(sys.argv[4:], indices.tolist(), scores.tolist()):
+			print(path, [(clsf.class_indices[index], score) for (index, score) in zip(row, row_scores)])
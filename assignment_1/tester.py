@@ -1,11 +1,20 @@
 #!/usr/bin/env python3
 from preprocessor import Preprocessor
 from tokenizer import Tokenizer
-from naive_bayes import MultinomialNaiveBayes, BinarizedMultinomialNaiveBayes, NormalizingNaiveBayes
+from token_cache import TokenCache
+from corpus_pack import PackedCorpus
+import naive_bayes
+from naive_bayes import CountAccumulator, MultinomialNaiveBayes, BinarizedMultinomialNaiveBayes, NormalizingNaiveBayes
+from multiprocessing import Pool
+from functools import partial
 import numpy as np
 import getopt
 import sys
 
+# The token cache and the packed corpus of a worker process of test_authors().
+worker_cache = None
+worker_corpus = None
+
 def f_score(precision, recall, beta = 1):
 	""" Returns the f-score (harmonic mean) of the given parameters. """
 	return ((beta ** 2 + 1) * precision * recall) / ((beta ** 2) * precision + recall)
@@ -28,8 +37,93 @@ def print_multiple_scores(scores):
 			print_scores(scores[i])
 			print('\n')
 
+def print_multiple_intervals(intervals):
+	names = ['Bag of Words', 'Bag of Character N-Grams', 'Set of Words', 'Complexity Features']
+	score_names = ['Micro-averaged precision', 'Micro-averaged recall', 'Micro-averaged F-score (beta=1)',
+		'Macro-averaged precision', 'Macro-averaged recall', 'Macro-averaged F-score (beta=1)']
+	for i in range(len(intervals)):
+		if intervals[i] is not None:
+			print('95% confidence intervals for the',names[i],'feature set:')
+			for (name, lower, upper) in zip(score_names, intervals[i][0].tolist(), intervals[i][1].tolist()):
+				print(name + ':', lower, '-', upper)
+			print('\n')
+
+def open_tokenizer(path, cache = None, corpus = None):
+	""" Returns the tokenizer of a document. The document is read from the packed corpus
+	if it is given, or through the token cache if it is given.
+	"""
+	if corpus is not None:
+		return corpus.tokenizer(path)
+	return Tokenizer(path) if cache is None else cache.tokenizer(path)
+
+def featurize_document(path, words = True, ngram_len = None, features = False, num_buckets = None, cache = None, corpus = None):
+	""" Extracts the requested representations of the document at the given path in a single pass.
+	See Tokenizer.extract for the arguments. This is a module level function so that it can be
+	sent to worker processes.
+
+	Returns a 3-tuple of the bag of words, the bag of char n-grams and the features.
+	"""
+	return open_tokenizer(path, cache, corpus).extract(words, ngram_len, features, num_buckets)
+
+def init_worker(cache, corpus):
+	""" Keeps the token cache and the packed corpus in the worker process, so that they are
+	only sent (and the shards only mapped and indexed) once, and the tasks only hold paths.
+	"""
+	global worker_cache, worker_corpus
+	worker_cache = cache
+	worker_corpus = corpus
+
+def featurize_worker_document(path, **kwargs):
+	""" Featurizes a document with the token cache and the packed corpus of the worker process.
+	See featurize_document for the arguments.
+	"""
+	return featurize_document(path, cache = worker_cache, corpus = worker_corpus, **kwargs)
+
+def featurize(paths, classifiers, ngram_len, num_buckets = None, cache = None, corpus = None, pool = None):
+	""" Extracts all representations needed by the given classifiers from the given documents.
+	The classifiers are in the order used by test_authors. The bag of words is shared
+	by the bag of words and the set of words classifiers.
+
+	If pool is a multiprocessing pool, the documents are featurized by its workers, which
+	must have been initialized with the same cache and corpus by init_worker. In any case, the results are in the order of the given paths.
+
+	Returns an iterator over the 3-tuples of the bag of words, the bag of char n-grams
+	and the features of each document.
+	"""
+	options = { 'words':classifiers[0] is not None or classifiers[2] is not None,
+		'ngram_len':ngram_len if classifiers[1] is not None else None,
+		'features':classifiers[3] is not None, 'num_buckets':num_buckets }
+	if pool is None:
+		return map(partial(featurize_document, cache = cache, corpus = corpus, **options), paths)
+	return pool.imap(partial(featurize_worker_document, **options), paths, chunksize = 16)
+
+def accumulate_documents(docs, words = True, ngram_len = None, features = False, num_buckets = None, cache = None, corpus = None,
+	track_df = False):
+	""" Featurizes a chunk of training documents, given as (author, path) tuples, and accumulates
+	their counts. This is a module level function so that it can be sent to worker processes.
+
+	Returns a 3-tuple of the CountAccumulator of the bags of words, the CountAccumulator of the
+	bags of char n-grams and the list of (author, features) tuples of the documents.
+	"""
+	bags = CountAccumulator(track_df) if words else None
+	ngram_bags = CountAccumulator(track_df) if ngram_len is not None else None
+	doc_features = []
+	for (author, path) in docs:
+		bag, ngrams, feats = featurize_document(path, words, ngram_len, features, num_buckets, cache, corpus)
+		if bags is not None: bags.add_feature_counts(author, bag)
+		if ngram_bags is not None: ngram_bags.add_feature_counts(author, ngrams)
+		if features: doc_features.append((author, feats))
+	return bags, ngram_bags, doc_features
+
+def accumulate_worker_documents(docs, **kwargs):
+	""" Accumulates a chunk of training documents with the token cache and the packed corpus of
+	the worker process. See accumulate_documents for the arguments.
+	"""
+	return accumulate_documents(docs, cache = worker_cache, corpus = worker_corpus, **kwargs)
+
 def test_authors(p, bag_of_words = True, alpha = 0.05, bag_of_char_ngrams = False, ngram_len = 5, set_of_words = False, complexity_features = False,
-	print_predictions = True):
+	print_predictions = True, num_buckets = None, cache = None, jobs = 1, corpus = None, batch_size = 256,
+	save_prefix = None, load_prefix = None, bootstrap = 0):
 	""" Tests the classifiers with the given feature sets.
 
 	p is the Preprocessor object holding the path data. It must have been initialized by
@@ -39,7 +133,8 @@ def test_authors(p, bag_of_words = True, alpha = 0.05, bag_of_char_ngrams = Fals
 	with the given alpha and bag of words as the feature set.
 
 	If bag_of_char_ngrams argument is True, the program uses Multinomial Naive Bayes classifier
-	with the given alpha, and a bag of character n-grams as the feature set.
+	with the given alpha, and a bag of character n-grams as the feature set. Ngram_len can also be
+	a list of n values. If num_buckets is given, the n-grams are hashed into that many buckets.
 
 	If set_of_words argument is True, the program uses Binarized Multinomial Naive Bayes clasifier
 	with the given alpha, and a set of words as the feature set.
@@ -48,6 +143,21 @@ def test_authors(p, bag_of_words = True, alpha = 0.05, bag_of_char_ngrams = Fals
 	is my term for a classifier which simply fits all features for all classes into their own normal
 	distributions and calculates probabilities using the pdfs.
 
+	If cache is a TokenCache, the documents are tokenized through it, so that they are
+	only tokenized once for all runs. If corpus is a PackedCorpus, the documents are read from
+	it instead of the file system, and the cache is not used.
+
+	If jobs is greater than 1, the documents are featurized by that many worker processes.
+	The features are merged in the same order as the serial run, so the results are identical.
+
+	The test documents are classified in batches of batch_size documents.
+
+	If save_prefix is given, the trained classifiers are saved to files starting with it.
+	If load_prefix is given, the classifiers are loaded from such files instead of being trained.
+
+	If bootstrap is greater than 0, the 95% bootstrap confidence intervals of the scores are computed
+	with that many resamples of the test set and printed.
+
 	Returns a 4-tuple, each being the score tuple a different feature set, in the order they are written
 	above. Any feature sets not used will return a score of None.
 	"""
@@ -57,52 +167,124 @@ def test_authors(p, bag_of_words = True, alpha = 0.05, bag_of_char_ngrams = Fals
 		None if not set_of_words else BinarizedMultinomialNaiveBayes(authors, alpha = alpha),
 		None if not complexity_features else NormalizingNaiveBayes(authors, 8))
 
+	pool = Pool(jobs, initializer = init_worker, initargs = (cache, corpus)) if jobs > 1 else None
+	try:
+		if load_prefix is not None:
+			classifiers = load_classifiers(classifiers, load_prefix)
+		else:
+			train_classifiers(p, authors, classifiers, ngram_len, num_buckets, cache, corpus, pool)
+			if save_prefix is not None:
+				save_classifiers(classifiers, save_prefix)
+		return test_classifiers(p, authors, classifiers, ngram_len, num_buckets, cache, corpus, pool, print_predictions,
+			batch_size, bootstrap)
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+
+def model_path(prefix, i):
+	""" Returns the path of the saved classifier of the i'th feature set. """
+	return '{}.{}.nbm'.format(prefix, ['words', 'ngrams', 'set', 'complexity'][i])
+
+def save_classifiers(classifiers, prefix):
+	""" Saves the trained classifiers next to each other with the given path prefix. """
+	for (i, clsf) in enumerate(classifiers):
+		if clsf is not None: clsf.save(model_path(prefix, i))
+
+def load_classifiers(classifiers, prefix):
+	""" Loads the saved classifiers of the feature sets whose classifiers are not None. """
+	return tuple(None if clsf is None else naive_bayes.load(model_path(prefix, i)) for (i, clsf) in enumerate(classifiers))
+
+def train_classifiers(p, authors, classifiers, ngram_len, num_buckets, cache, corpus, pool, chunk_size = 16):
+	""" Trains the given classifiers. See test_authors for the arguments.
+	The training documents are featurized and counted in chunks of chunk_size documents.
+	"""
 	# Train the bayes classifiers for each training data
 	for author in authors:
 		for clsf in classifiers:
 			if clsf is not None: clsf.add_documents(author, len(p.training_data(author)))
 
-		for data in p.training_data(author):
-
-			# Featurize and add features to the classifiers
-			t = Tokenizer(p.file_path(author,data))
-			if classifiers[0] is not None: classifiers[0].add_feature_counts(author, t.bag_of_words())
-			if classifiers[1] is not None: classifiers[1].add_feature_counts(author, t.bag_of_char_ngrams(ngram_len))
-			if classifiers[2] is not None: classifiers[2].add_feature_counts(author, t.bag_of_words())
-			if classifiers[3] is not None: classifiers[3].add_features(author, classifiers[3].vectorize(t.features()))
+	# The counts of each chunk of documents are accumulated separately (by the workers, if there is a pool)
+	# and added to the classifiers in the order of the documents.
+	training_docs = [(author, p.file_path(author,data)) for author in authors for data in p.training_data(author)]
+	chunks = [training_docs[start:start+chunk_size] for start in range(0, len(training_docs), chunk_size)]
+	options = { 'words':classifiers[0] is not None or classifiers[2] is not None,
+		'ngram_len':ngram_len if classifiers[1] is not None else None, 'features':classifiers[3] is not None,
+		'num_buckets':num_buckets, 'track_df':any(clsf is not None and clsf.doc_freq is not None for clsf in classifiers[:3]) }
+	if pool is None:
+		accumulated = map(partial(accumulate_documents, cache = cache, corpus = corpus, **options), chunks)
+	else:
+		accumulated = pool.imap(partial(accumulate_worker_documents, **options), chunks)
+	for (bags, ngram_bags, doc_features) in accumulated:
+		# Add the features of the documents to the classifiers
+		if classifiers[0] is not None: classifiers[0].add_counts(bags)
+		if classifiers[1] is not None: classifiers[1].add_counts(ngram_bags)
+		if classifiers[2] is not None: classifiers[2].add_counts(bags)
+		for (author, features) in doc_features:
+			if classifiers[3] is not None: classifiers[3].add_features(author, classifiers[3].vectorize(features))
 
 	for clsf in classifiers:
 		if clsf is not None: clsf.train()
 
-	testers = (None if not bag_of_words else Tester(classifiers[0].get_classes()),
-		None if not bag_of_char_ngrams else Tester(classifiers[1].get_classes()),
-		None if not set_of_words else Tester(classifiers[2].get_classes()),
-		None if not complexity_features else Tester(classifiers[3].get_classes()))
+def test_classifiers(p, authors, classifiers, ngram_len, num_buckets, cache, corpus, pool, print_predictions, batch_size, bootstrap = 0):
+	""" Tests the given trained classifiers. See test_authors for the arguments. """
+	testers = tuple(None if clsf is None else Tester(clsf.get_classes()) for clsf in classifiers)
 
-	# Check the classifier predictions for each test data
-	for author in authors:
-		for data in p.test_data(author):
-
-			# Featurize and classify
-			t = Tokenizer(p.file_path(author,data, training_data = False))
-			class_predicted = [None, None, None, None]
-			if classifiers[0] is not None:
-				class_predicted[0] = classifiers[0].most_probable_class(classifiers[0].vectorize(t.bag_of_words()))
-				testers[0].add_stat(class_predicted[0], author)
-			if classifiers[1] is not None:
-				class_predicted[1] = classifiers[1].most_probable_class(classifiers[1].vectorize(t.bag_of_char_ngrams(ngram_len)))
-				testers[1].add_stat(class_predicted[1], author)
-			if classifiers[2] is not None:
-				class_predicted[2] = classifiers[2].most_probable_class(classifiers[2].vectorize(t.bag_of_words()))
-				testers[2].add_stat(class_predicted[2], author)
-			if classifiers[3] is not None:
-				class_predicted[3] = classifiers[3].most_probable_class(classifiers[3].vectorize(t.features()))
-				testers[3].add_stat(class_predicted[3], author)
-			if print_predictions: print('predicted:',[pr for pr in class_predicted if pr is not None],'actual:',author)
-		
+	# Check the classifier predictions for the test data in batches
+	test_docs = [(author, data) for author in authors for data in p.test_data(author)]
+	test_paths = [p.file_path(author,data, training_data = False) for (author, data) in test_docs]
+	batch = []
+	for ((author, data), doc_features) in zip(test_docs,
+		featurize(test_paths, classifiers, ngram_len, num_buckets, cache, corpus, pool)):
+		batch.append((author, doc_features))
+		if len(batch) >= batch_size:
+			classify_batch(classifiers, testers, batch, print_predictions)
+			batch = []
+	classify_batch(classifiers, testers, batch, print_predictions)
+
+	if bootstrap > 0:
+		print_multiple_intervals([None if tester is None else tester.bootstrap(bootstrap) for tester in testers])
 	return (testers[0].scores() if testers[0] is not None else None, testers[1].scores() if testers[1] is not None else None,
 		testers[2].scores() if testers[2] is not None else None, testers[3].scores() if testers[3] is not None else None)
 
+def classify_batch(classifiers, testers, batch, print_predictions = False):
+	""" Classifies a batch of featurized test documents with each classifier in a single
+	matrix multiplication and adds the predictions to the testers.
+
+	Batch is a list of 2-tuples of the actual author and the 3-tuple of features
+	returned by featurize.
+	"""
+	if len(batch) == 0:
+		return
+	predictions = [None, None, None, None]
+	for (i, clsf) in enumerate(classifiers):
+		if clsf is not None:
+			# The bag of words is used by both the bag of words and set of words classifiers.
+			feature_ind = (0, 1, 0, 2)[i]
+			indices, scores = clsf.predict_batch(clsf.vectorize_batch([features[feature_ind] for (author, features) in batch]))
+			testers[i].add_stats(indices, [testers[i].classes[author] for (author, features) in batch])
+			predictions[i] = [clsf.class_indices[index] for index in indices]
+	if print_predictions:
+		for (k, (author, features)) in enumerate(batch):
+			print('predicted:',[pred[k] for pred in predictions if pred is not None],'actual:',author)
+
+def confusion_matrix(real, predicted, num_classes):
+	""" Builds the confusion matrix (real classes as rows) of arrays of real and predicted class indices. """
+	codes = np.asarray(real, dtype=np.int64) * num_classes + np.asarray(predicted, dtype=np.int64)
+	return np.bincount(codes, minlength = num_classes * num_classes).reshape((num_classes, num_classes))
+
+def confusion_scores(stats):
+	""" Returns the 6 scores (see Tester.scores) of a confusion matrix, or of a stack of confusion
+	matrices, in which case there is one row of scores per matrix. Nan values are ignored in the
+	macro-averages.
+	"""
+	correct = np.diagonal(stats, axis1=-2, axis2=-1)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		micro = correct.sum(axis=-1) / stats.sum(axis=(-2,-1))
+		macro_prec = np.nanmean(correct / stats.sum(axis=-2), axis=-1)
+		macro_rec = np.nanmean(correct / stats.sum(axis=-1), axis=-1)
+		return np.stack([micro, micro, f_score(micro, micro), macro_prec, macro_rec, f_score(macro_prec, macro_rec)], axis=-1)
+
 class Tester:
 	""" Tester for a single Naive Bayes classifier. """
 	def __init__(self, classes):
@@ -114,6 +296,10 @@ class Tester:
 		""" Adds a single stat to the confusion matrix. """
 		self.stats[self.classes[real_class],self.classes[predicted_class]] += 1
 
+	def add_stats(self, predicted, real):
+		""" Adds the stats of arrays of predicted and real class indices to the confusion matrix. """
+		self.stats += confusion_matrix(real, predicted, len(self.classes))
+
 	def microavg_precision(self):
 		""" Returns the micro-averaged precision value. """
 		return np.trace(self.stats) / np.sum(self.stats)
@@ -136,27 +322,56 @@ class Tester:
 
 	def scores(self):
 		""" Returns a 6-tuple of scores. """
-		micro_prec = self.microavg_precision()
-		micro_rec = self.microavg_recall()
-		micro_f = f_score(micro_prec, micro_rec)
-		macro_prec = self.macroavg_precision()
-		macro_rec = self.macroavg_recall()
-		macro_f = f_score(macro_prec, macro_rec)
-		return micro_prec, micro_rec, micro_f, macro_prec, macro_rec, macro_f
+		return tuple(confusion_scores(self.stats).tolist())
+
+	def bootstrap(self, resamples = 1000, confidence = 0.95, seed = None, max_cells = 2 ** 24):
+		""" Returns the bootstrap confidence intervals of the scores as a 2-tuple of the arrays of
+		the lower and upper bounds, in the order of the scores.
+
+		Resampling the test documents with replacement is the same as drawing the cells of the
+		confusion matrix from a multinomial distribution with the observed cell frequencies, so
+		all resampled confusion matrices are drawn at once, without the predictions themselves.
+		Max_cells bounds the number of confusion matrix cells drawn at once.
+		"""
+		rng = np.random.RandomState(seed)
+		num_docs = int(self.stats.sum())
+		cells = self.stats.ravel() / max(1, num_docs)
+		step = max(1, max_cells // max(1, len(cells)))
+		scores = np.concatenate([confusion_scores(rng.multinomial(num_docs, cells, size = min(step, resamples - start)).reshape((-1,) + self.stats.shape))
+			for start in range(0, resamples, step)])
+		tail = (1 - confidence) / 2 * 100
+		with np.errstate(invalid='ignore'):
+			return np.nanpercentile(scores, tail, axis=0), np.nanpercentile(scores, 100 - tail, axis=0)
 
 if __name__ == '__main__':
 	""" This program normally accepts two arguments: the directory of the training set and
 	the directory of the test set. If used, the -p option will make the program do the 
 	training/test set preprocessing with the given outer directory. If -p is used,
 	the -s option followed by a number can also be used to set the random seed
-	for test data shuffling.
+	for test data shuffling. The -c option followed by a directory makes the program
+	cache the tokenized documents in that directory. The -j option followed by a number
+	sets the number of worker processes that featurize the documents. The -m option followed
+	by a manifest path (see preprocessor.py) uses the split in the manifest instead of the
+	training and test directories. The -d option followed by a comma separated list of shard
+	paths (see corpus_pack.py) reads the documents from the packed corpus. The -o option followed
+	by a path prefix saves the trained classifiers, and the -l option followed by a path prefix loads
+	them instead of training, in which case the training directory is not read. The -b option followed
+	by a number prints the 95% bootstrap confidence intervals of the scores with that many resamples.
 	"""
 	seed = None
 	prep = False
+	cache = None
+	jobs = 1
+	manifest_path = None
+	corpus = None
+	save_prefix = None
+	load_prefix = None
+	bootstrap = 0
 	argv = []
 	p = Preprocessor()
 	try:
-		optlist, argv = getopt.getopt(sys.argv[1:], 'ps:', ["seed=", "preprocess"])
+		optlist, argv = getopt.getopt(sys.argv[1:], 'ps:c:j:m:d:o:l:b:', ["seed=", "preprocess", "cache=", "jobs=", "manifest=", "packed=",
+			"save=", "load=", "bootstrap="])
 	except getopt.GetoptError as err:
 		# print help information and exit:
 		print(err) # will print something like "option -a not recognized"
@@ -167,10 +382,26 @@ if __name__ == '__main__':
 			seed = a
 		elif o in("-p","--preprocess"):
 			prep = True
+		elif o in("-c","--cache"):
+			cache = TokenCache(a)
+		elif o in("-j","--jobs"):
+			jobs = int(a)
+		elif o in("-m","--manifest"):
+			manifest_path = a
+		elif o in("-d","--packed"):
+			corpus = PackedCorpus(a.split(','))
+		elif o in("-o","--save"):
+			save_prefix = a
+		elif o in("-l","--load"):
+			load_prefix = a
+		elif o in("-b","--bootstrap"):
+			bootstrap = int(a)
 		else:
 			assert False, "unhandled option"
 
-	if prep:
+	if manifest_path is not None:
+		p.organize_authors(manifest_path = manifest_path)
+	elif prep:
 		if len(argv) < 1:
 			print('Please enter the directory to load authors from.')
 			sys.exit(2)
@@ -185,5 +416,6 @@ if __name__ == '__main__':
 			p.organize_authors(argv[0], argv[1])
 	with np.errstate(divide='ignore', invalid='ignore'):	
 		scores = test_authors(p, bag_of_words = True, alpha = 0.05, bag_of_char_ngrams = True, ngram_len = 5,
-			set_of_words = False, complexity_features = False, print_predictions = False)
+			set_of_words = False, complexity_features = False, print_predictions = False, cache = cache, jobs = jobs, corpus = corpus,
+			save_prefix = save_prefix, load_prefix = load_prefix, bootstrap = bootstrap)
 		print_multiple_scores(scores)
\ No newline at end of file
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+from tokenizer import Tokenizer, stopwords, token_re, sentence_re, casing_rule
+import numpy as np
+import hashlib
+import os
+import sys
+
+# Incremented whenever the layout of the cached documents changes.
+cache_format = 1
+# Number of int32 values at the start of a cached document, before the sentence data.
+header_len = 4
+punctuation = '!?.'
+
+def digest(*parts):
+	""" Returns the hex digest of the given parts. """
+	return hashlib.sha1('\0'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+def file_stamp(path):
+	""" Returns the absolute path, modification time and size of a file as a tuple. """
+	st = os.stat(path)
+	return os.path.abspath(path), st.st_mtime_ns, st.st_size
+
+class CachedTokenizer(Tokenizer):
+	""" A Tokenizer that reads its tokens from a cached tokenization instead of the text.
+	Supports the token stream, bag of words, bag of char n-grams and features use cases.
+	The sentences themselves are not available.
+
+	The cached array consists of the number of sentences, the counts of '!', '?' and '.',
+	the number of tokens in each sentence, the number of commas in each sentence and the
+	token ids, which index the vocabulary of the document.
+	"""
+	def __init__(self, data, vocab, lexicon = None):
+		Tokenizer.__init__(self, lexicon = lexicon)
+		self.data = data
+		self.vocab = vocab
+
+	def tokenized_sentences(self):
+		""" Returns a generator over the 2-tuples of the tokens and the number of commas of each sentence. """
+		sentence_count = int(self.data[0])
+		lengths = self.data[header_len:header_len+sentence_count].tolist()
+		commas = self.data[header_len+sentence_count:header_len+2*sentence_count].tolist()
+		ids = self.data[header_len+2*sentence_count:]
+		start = 0
+		for (length, comma_count) in zip(lengths, commas):
+			yield [self.vocab[i] for i in ids[start:start+length].tolist()], comma_count
+			start += length
+
+	def punctuation_count(self, char):
+		""" Returns the number of occurences of a punctuation character in the file. """
+		return int(self.data[1 + punctuation.index(char)])
+
+class TokenCache:
+	""" An on-disk cache of tokenized documents.
+	Each document is stored as an array of integer token ids into its own vocabulary,
+	which is memory-mapped on load. The documents are keyed by their path, modification
+	time and size, and by the tokenizer configuration (token and sentence regexes, stop
+	word files and casing rule), so stale entries are never used. Since every document
+	has its own vocabulary, several processes can share a cache directory.
+	"""
+	def __init__(self, path, lexicon = None):
+		""" Initializes the cache in the given directory for the given stop word lexicon. """
+		self.lexicon = stopwords if lexicon is None else lexicon
+		self.path = os.path.join(path, self.config_key())
+		os.makedirs(self.path, exist_ok=True)
+		self.hits = 0
+		self.misses = 0
+
+	def config_key(self):
+		""" Returns the key of the tokenizer configuration. """
+		lexicon_stamps = [file_stamp(path) for path in self.lexicon.paths]
+		return digest(cache_format, token_re.pattern, sentence_re.pattern, casing_rule, *lexicon_stamps)
+
+	def entry_path(self, path):
+		""" Returns the path prefix of the cache entry of a document. """
+		return os.path.join(self.path, digest(*file_stamp(path)))
+
+	def tokenizer(self, path):
+		""" Returns a tokenizer for the given document.
+		The document is tokenized and cached if it is not already in the cache.
+		"""
+		entry = self.entry_path(path)
+		try:
+			data = np.load(entry + '.npy', mmap_mode='r')
+			with open(entry + '.vocab', 'r', encoding = 'utf-8') as f:
+				vocab = f.read().split('\n')
+			self.hits += 1
+		except (IOError, ValueError):
+			data, vocab = self.store(path, entry)
+			self.misses += 1
+		return CachedTokenizer(data, vocab, self.lexicon)
+
+	def store(self, path, entry):
+		""" Tokenizes the given document and writes it to the cache entry.
+		The files are written under temporary names and then renamed, so that
+		concurrent readers never see a partially written entry.
+
+		Returns a 2-tuple of the cached array and the vocabulary.
+		"""
+		t = Tokenizer(path, lexicon = self.lexicon)
+		index = {}
+		lengths = []
+		commas = []
+		ids = []
+		for (tokens, comma_count) in t.tokenized_sentences():
+			lengths.append(len(tokens))
+			commas.append(comma_count)
+			ids.extend(index.setdefault(token, len(index)) for token in tokens)
+		header = [len(lengths)] + [t.punctuation_count(char) for char in punctuation]
+		data = np.array(header + lengths + commas + ids, dtype=np.int32)
+		vocab = list(index.keys())
+		tmp = '{}.{}.tmp'.format(entry, os.getpid())
+		with open(tmp + '.vocab', 'w', encoding = 'utf-8') as f:
+			f.write('\n'.join(vocab))
+		os.replace(tmp + '.vocab', entry + '.vocab')
+		np.save(tmp + '.npy', data)
+		os.replace(tmp + '.npy', entry + '.npy')
+		return data, vocab
+
+if __name__ == '__main__':
+	""" Accepts two arguments: the cache directory and a text path. Prints the cached tokens. """
+	if len(sys.argv) < 3:
+		print('Please enter the cache directory and the text path.')
+	else:
+		t = TokenCache(sys.argv[1]).tokenizer(sys.argv[2])
+		while t.has_next():
+			print(t.next_token())
@@ -1,14 +1,14 @@
 #!/usr/bin/env python3
+import io
 import re
 import sys
-import csv
 import math
-from collections import Counter
+from collections import Counter, deque
+from lexicon import Lexicon
+from ngrams import CharNgrams
 
-stopwords = []
-with open('stopwords-tr.csv', 'r') as f:
-	# Stop words are taken from http://www.turkceogretimi.com/Genel-Konular/article/541-turkce-etkisiz-kelimeler-stop-words-listesi-11/35
-	stopwords = [word for line in list(csv.reader(f)) for word in line]
+# The default stop word lexicon. It is not loaded until the first token is checked.
+stopwords = Lexicon()
 
 # Matches words by stripping all punctuation around it. Also strips the outer part of an apostrophe.
 token_re = re.compile(R"[!\"#$%&'()*+,\-./:;<=>?@[\]^_`{|}~]*([\w-]+)(?:'\w*)*[!\"#$%&'()*+,\-./:;<=>?@[\]^_`{|}~]*", re.U)
@@ -23,18 +23,30 @@ def is_number(s):
 		except ValueError:
 			return False
 
-def tokenize(line):
+# Describes the casing rule of tokenize(). It is a part of the tokenizer configuration
+# that cached tokenizations are keyed by.
+casing_rule = 'lowercase unless the whole token is uppercase'
+
+def tokenize(line, lexicon = None):
 		""" Tokenizes the given line by splitting it from whitespaces and punctuations
 		that are commonly found at the end of sentences. Does not include
-		tokens of length 0. All tokens are transformed to lowercase unless the whole
+		tokens of length 0 or the tokens found in the stop word lexicon (the default
+		lexicon if not given). All tokens are transformed to lowercase unless the whole
 		token is uppercase.
 
 		Returns a list of tokens.
 		"""
+		if lexicon is None:
+			lexicon = stopwords
 		m = re.findall(token_re, line.strip())
 		if m == None:
 			return []
-		return [ (lambda tok: tok if tok.isupper() else tok.lower())(token) for token in m if not(len(token) == 0 or token in stopwords) ]
+		# The frozenset is checked directly, and the lookups are counted once per line.
+		words = lexicon.get_words()
+		tokens = [ (lambda tok: tok if tok.isupper() else tok.lower())(token) for token in m if not(len(token) == 0 or token in words) ]
+		checked = len(m) - m.count('')
+		lexicon.add_stats(checked - len(tokens), len(tokens))
+		return tokens
 
 def half_round(number):
 	return round(number * 2) / 2
@@ -46,14 +58,32 @@ class Tokenizer:
 	2. List of all word tokens through bag_of_words() method.
 	3. List of all character n-grams through bag_of_char_ngrams() method.
 	4. List of features through features() method.
+	All of them can be used in streaming mode, where the file is read lazily in chunks.
 	"""
-	def __init__(self, path = None):
+	def __init__(self, path = None, stream = False, chunk_size = 65536, lexicon = None, buffer = None):
 		""" Initializes the tokenizer with the given text file path.
 		Note that the given files are assumed to be of Windows-1254 (Turkish)
 		encoding. Reads the whole file and splits it into sentences.
+
+		If stream is True, the file is not read up front. Instead, it is read
+		in chunks of chunk_size characters every time the sentences are iterated,
+		so that the memory usage does not depend on the size of the file.
+
+		Lexicon is the stop word lexicon to filter the tokens with. The default
+		stop word lexicon is used if it is not given.
+
+		If buffer is given instead of the path, the text is read from the bytes
+		in the buffer (ex: a slice of a packed corpus) without opening a file.
 		"""
-		if not path == None:
-			file = open(path, 'r', encoding = 'cp1254')
+		self.path = path
+		self.buffer = buffer
+		self.lexicon = stopwords if lexicon is None else lexicon
+		self.stream = stream and (path is not None or buffer is not None)
+		self.chunk_size = chunk_size
+		if self.stream:
+			self.sentences = []
+		elif not (path is None and buffer is None):
+			file = self.open_text()
 			lines = file.readlines()
 			file.close()
 			self.original = " ".join(lines)
@@ -61,15 +91,90 @@ class Tokenizer:
 		else:
 			self.sentences = []
 		self.tokens = {}
-		self.line = []
+		self.line = deque()
+		self.sentence_iter = None
+
+	def open_text(self):
+		""" Opens the text of the file or the buffer as a Windows-1254 (Turkish) text stream. """
+		if self.buffer is not None:
+			return io.TextIOWrapper(io.BytesIO(self.buffer), encoding = 'cp1254')
+		return open(self.path, 'r', encoding = 'cp1254')
 
 	def append_sentences(self, sentences):
-		""" Appends sentences to already existing sentences. """
+		""" Appends sentences to already existing sentences.
+		In streaming mode, these are iterated after the sentences of the file.
+		"""
 		self.sentences.extend(sentences)
 
+	def iter_sentences(self):
+		""" Returns a generator over the sentences.
+		In streaming mode, every call reads the file again from the beginning.
+		"""
+		if self.stream:
+			yield from self.stream_sentences()
+		yield from self.sentences
+
+	def stream_sentences(self):
+		""" Lazily reads the file in chunks and yields its sentences.
+		Sentences that cross chunk boundaries are carried over to the next chunk.
+		Only the sentence ends that are followed by at least one more character
+		are trusted, since the sentence regex looks ahead of the dots.
+		"""
+		self.punctuation = Counter()
+		with self.open_text() as file:
+			# The unfinished sentence is kept in pieces, and only its tail is searched again with the next chunk.
+			head = []
+			tail = ''
+			pos = 0
+			while True:
+				chunk = file.read(self.chunk_size)
+				for c in '!?.':
+					self.punctuation[c] += chunk.count(c)
+				# Lines are joined with a space in the non-streaming mode as well.
+				text = tail + chunk.replace('\n', '\n ')
+				start = 0
+				m = None
+				for m in sentence_re.finditer(text, pos):
+					# At the end of the file, the matches that reach the end are trusted as well.
+					if m.end() >= len(text) and chunk != '':
+						break
+					sentence = (''.join(head) + text[start:m.start()]).strip()
+					head = []
+					if not sentence == '':
+						yield sentence
+					start = m.end()
+				if chunk == '':
+					break
+				# Nothing before the last unfinished match can start a new one.
+				search = max(start, len(text) - 1) if m is None or m.end() < len(text) else m.start()
+				# The character before the next search is kept for the lookbehinds of the sentence regex.
+				cut = max(start, search - 1)
+				head.append(text[start:cut])
+				tail = text[cut:]
+				pos = search - cut
+		sentence = (''.join(head) + text[start:]).strip()
+		if not sentence == '':
+			yield sentence
+
+	def tokenized_sentences(self):
+		""" Returns a generator over the 2-tuples of the tokens and the number of commas of each sentence. """
+		for sentence in self.iter_sentences():
+			yield tokenize(sentence, self.lexicon), sentence.count(',')
+
+	def punctuation_count(self, char):
+		""" Returns the number of occurences of a punctuation character in the file.
+		In streaming mode, the count is known after the sentences are read.
+		"""
+		return self.punctuation[char] if self.stream else self.original.count(char)
+
+	def iter_tokens(self):
+		""" Returns a generator over the tokens of all sentences. """
+		for tokens, commas in self.tokenized_sentences():
+			yield from tokens
+
 	def bag_of_words(self):
 		""" Returns the bag of words representation of the file. """
-		return Counter([token for sentence in self.sentences for token in tokenize(sentence)])
+		return Counter(self.iter_tokens())
 
 	def char_ngrams(self, token, n):
 		""" Returns the list of char n-grams from a given token. """
@@ -79,9 +184,12 @@ class Tokenizer:
 			lis.append(token[i:i+n])
 		return lis
 
-	def bag_of_char_ngrams(self, n):
-		""" Returns the bag of char n-grams representation of the file. """
-		return Counter([ngram for sentence in self.sentences for token in tokenize(sentence) for ngram in self.char_ngrams(token,n)])
+	def bag_of_char_ngrams(self, n, num_buckets = None):
+		""" Returns the bag of char n-grams representation of the file.
+		N can also be a list of n values. If num_buckets is given, the n-grams
+		are hashed and a 2-tuple of id and count arrays is returned instead.
+		"""
+		return self.extract(words = False, ngram_len = n, num_buckets = num_buckets)[1]
 
 	def features(self):
 		""" Returns features extracted from sentences.
@@ -90,44 +198,67 @@ class Tokenizer:
 			list of number of exclamation marks in a sentence, list of number of question marks in a sentence, list of number 
 			of periods in a sentence, average number of unique words per word)
 		"""
+		return self.extract(words = False, features = True)[2]
+
+	def extract(self, words = True, ngram_len = None, features = False, num_buckets = None):
+		""" Extracts several representations of the file while tokenizing it only once.
+		If words is True, the bag of words is built. If ngram_len is given, the bag of
+		char n-grams of that length (or lengths, if it is a list) is built, hashed into
+		num_buckets if it is given (see bag_of_char_ngrams). If features is True, the
+		features as described in features() are built.
+
+		Returns a 3-tuple of the bag of words, the bag of char n-grams and the features.
+		The representations that are not requested are None.
+		"""
+		bag = Counter()
+		ngrams = None if ngram_len is None else CharNgrams(ngram_len, num_buckets).accumulator()
 		words_in_sentences = []
 		word_len = []
 		commas_in_sentences = []
-		total_excl = self.original.count('!')
-		excl = [] + [1] * total_excl + [0] * max(0,len(self.sentences)-total_excl)
-		total_ques = self.original.count('?')
-		ques = [] + [1] * total_ques + [0] * max(0,len(self.sentences)-total_ques)
-		total_period = self.original.count('.')
-		period = [] + [1] * total_period + [0] * max(0,len(self.sentences)-total_period)
-		unique_words = set([])
-		word_count = 0
-		for sentence in self.sentences:
-			commas_in_sentences.append(sentence.count(','))
-			words = tokenize(sentence)
-			words_in_sentences.append(len(words))
-			for word in words:
-				word_len.append(len(word))
-				unique_words.add(word)
-				word_count+=1
-		return len(self.sentences), words_in_sentences, word_len, commas_in_sentences, excl, ques, period, len(unique_words)/word_count
+		sentence_count = 0
+		for tokens, commas in self.tokenized_sentences():
+			if words or features:
+				bag.update(tokens)
+			if ngrams is not None:
+				ngrams.add(tokens)
+			if features:
+				sentence_count += 1
+				commas_in_sentences.append(commas)
+				words_in_sentences.append(len(tokens))
+				word_len.extend(len(token) for token in tokens)
+		if ngrams is not None:
+			ngrams = ngrams.result()
+		if not features:
+			return bag if words else None, ngrams, None
+		count = self.punctuation_count
+		total_excl = count('!')
+		excl = [] + [1] * total_excl + [0] * max(0,sentence_count-total_excl)
+		total_ques = count('?')
+		ques = [] + [1] * total_ques + [0] * max(0,sentence_count-total_ques)
+		total_period = count('.')
+		period = [] + [1] * total_period + [0] * max(0,sentence_count-total_period)
+		feature_tpl = (sentence_count, words_in_sentences, word_len, commas_in_sentences, excl, ques, period,
+			len(bag)/len(word_len))
+		return bag if words else None, ngrams, feature_tpl
 
 	def has_next(self):
 		""" Returns True if the token stream has any tokens left.
 
 		Handles the acquiring of new tokens from the given token stream (file).
-		Note that the sentences are exhausted using this method.
+		Note that the sentence stream is exhausted using this method.
 		"""
-		if len(self.line) > 0: return True
-		if len(self.sentences) == 0: return False
-		else:
-			line = self.sentences.pop(0)
-			self.line = tokenize(line)
-			return self.has_next()
+		if self.sentence_iter is None:
+			self.sentence_iter = self.tokenized_sentences()
+		while len(self.line) == 0:
+			line = next(self.sentence_iter, None)
+			if line is None: return False
+			self.line = deque(line[0])
+		return True
 
 	def next_token(self):
 		""" Returns the next token in the token stream. """
 		if len(self.line) > 0:
-			token = self.line.pop(0)
+			token = self.line.popleft()
 			if token in self.tokens:
 				self.tokens[token] = self.tokens[token] + 1
 			else:
@@ -141,7 +272,7 @@ if __name__ == '__main__':
 	if len(sys.argv) < 2:
 		print('Please enter the directory to load the text from.')
 	else:
-		t = Tokenizer(sys.argv[1])
+		t = Tokenizer(sys.argv[1], stream = True)
 		while t.has_next():
 			token = t.next_token()
 			print(token)
\ No newline at end of file
@@ -6,24 +6,26 @@ def get_sentences(path):
 	Each element of the sentence is a 4-tuple, denoting the
 	form, lemma, cpostag, and postag.
 	"""
-	lines = []
+	return list(iter_sentences(path))
+
+def iter_sentences(path):
+	""" Returns a generator over the sentences of a path, which reads
+	the file one line at a time. See get_sentences().
+	"""
 	with open(path, 'r', encoding = 'utf-8') as fp:
-		lines = fp.readlines()
-	sentences = []
-	acc = []
-	for line in lines:
-		word = line.strip().split('\t')
-		if not len(word) < 2:
-			if word[1] is not '_':
-				try:
-					acc.append((word[1],word[3],word[4]))
-				except IndexError: # There is no postag or cpostag.
-					acc.append((word[1],None,None))
-		else: # End of a sentence.
-			sentences.append(acc)
-			acc = []
-	sentences.append(acc)
-	return sentences 
+		acc = []
+		for line in fp:
+			word = line.strip().split('\t')
+			if not len(word) < 2:
+				if word[1] is not '_':
+					try:
+						acc.append((word[1],word[3],word[4]))
+					except IndexError: # There is no postag or cpostag.
+						acc.append((word[1],None,None))
+			else: # End of a sentence.
+				yield acc
+				acc = []
+		yield acc
 
 def tag_ind(tag_type = 'cpostag'):
 	return 1 if tag_type is 'cpostag' else 2
@@ -12,20 +12,21 @@ def get_pred_sentences(path):
 
 	Works on inputs like the example test output, ie. split by |.
 	"""
-	lines = []
+	return list(iter_pred_sentences(path))
+
+def iter_pred_sentences(path):
+	""" Returns a generator over the sentences of a path, which reads
+	the file one line at a time. See get_pred_sentences().
+	"""
 	with open(path, 'r', encoding = 'utf-8') as fp:
-		lines = fp.readlines()
-	sentences = []
-	acc = []
-	for line in lines:
-		word = line.strip().split('|')
-		if not len(word) < 2:
-			acc.append((word[0],word[1],word[1]))
-		else: # End of a sentence.
-			if acc is not []:
-				sentences.append(acc)
+		acc = []
+		for line in fp:
+			word = line.strip().split('|')
+			if not len(word) < 2:
+				acc.append((word[0],word[1],word[1]))
+			else: # End of a sentence.
+				yield acc
 				acc = []
-	return sentences 
 
 class Tester:
 	""" Tester for HMM POS tagger. """
@@ -39,10 +40,10 @@ class Tester:
 		""" Builds the confusion matrix.
 		The given predicted sentences and the gold standard sentences
 		must be of the same length. The total number of sentences must
-		also match.
+		also match. The sentences can also be generators, in which case
+		they are only read once.
 		""" 
-		for i, gold_sent in enumerate(gold_sentences):
-			pr_sent = predicted_sentences[i]
+		for gold_sent, pr_sent in zip(gold_sentences, predicted_sentences):
 			for j, gold_word in enumerate(gold_sent):
 				pr_word = pr_sent[j]
 				known = pr_word[0] in vocab
@@ -113,8 +114,8 @@ if __name__ == '__main__':
 		hmm = hmm_train.HMM()
 		hmm.load(hmm_train.config_path)
 
-		sentences = cpar.get_sentences(gold_filepath)
-		pr_sentences = get_pred_sentences(output_filepath)
+		sentences = cpar.iter_sentences(gold_filepath)
+		pr_sentences = iter_pred_sentences(output_filepath)
 
 		t = Tester(hmm.tags)
 		t.build(sentences, pr_sentences, hmm.tag_ind, vocab = hmm.vocab)
@@ -3,10 +3,130 @@ import io
 import sys
 import train_hmm_tagger as hmm_train
 import conll_parser as cpar
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+import numpy as np
 
-def pos_tag(hmm, sentences):
-	""" Returns POS tagged versions of the given sentences. """
-	return [viterbi(hmm,sentence) for sentence in sentences]
+# The HMM of a worker process of tag_file().
+worker_hmm = None
+
+def pos_tag(hmm, sentences, bucket_size = 64):
+	""" Returns POS tagged versions of the given sentences.
+	The sentences are sorted by length and decoded in buckets of bucket_size
+	sentences (see batched_viterbi). The output is in the order of the input.
+	If bucket_size is None, the sentences are decoded one by one.
+	"""
+	if bucket_size is None:
+		return [vectorized_viterbi(hmm, sentence) for sentence in sentences]
+	order = sorted(range(len(sentences)), key = lambda i: len(sentences[i]))
+	tagged = [None] * len(sentences)
+	for start in range(0, len(order), bucket_size):
+		bucket = order[start:start+bucket_size]
+		for (i, sent) in zip(bucket, batched_viterbi(hmm, [sentences[i] for i in bucket])):
+			tagged[i] = sent
+	return tagged
+
+def iter_pos_tag(hmm, sentences, chunk_size = 1024, bucket_size = 64):
+	""" Returns a generator over the POS tagged versions of the given sentences,
+	which can themselves be a generator. The sentences are tagged in chunks of
+	chunk_size sentences (see pos_tag), so only one chunk is kept in memory.
+	"""
+	sentences = iter(sentences)
+	for chunk in iter(lambda: list(islice(sentences, chunk_size)), []):
+		for sentence in pos_tag(hmm, chunk, bucket_size):
+			yield sentence
+
+def batched_viterbi(hmm, sentences):
+	""" Implements the Viterbi algorithm for a batch of sentences at once.
+	The sentences are padded to the length of the longest one, and each column is computed
+	with a single array operation over the (sentence, previous tag, tag) triples. Unknown
+	words only allow the most common tag, and the padding keeps the cells of the shorter
+	sentences as they are. The results are the same as those of vectorized_viterbi(), so
+	the sentences should have similar lengths for the least padding.
+	"""
+	num_tags = len(hmm.tag_list)
+	lengths = np.array([len(sentence) for sentence in sentences], dtype=np.int64)
+	max_len = int(lengths.max()) if len(sentences) > 0 else 0
+	words = [sentence[i][0] if i < len(sentence) else None for sentence in sentences for i in range(max_len)]
+	word_lps = hmm.word_log_probs_batch(words).reshape((len(sentences), max_len, num_tags))
+	known = np.array([word in hmm.word_ids for word in words], dtype=bool).reshape((len(sentences), max_len))
+	# Tags that are not allowed for an unknown word.
+	unknown_mask = np.ones((num_tags,), dtype=bool)
+	if hmm.common_tag is not None:
+		unknown_mask[hmm.tag_ids[hmm.common_tag]] = False
+	all_ids = np.arange(num_tags)
+	batch_ids = np.arange(len(sentences))[:,np.newaxis]
+	log_trans = hmm.log_start[np.newaxis,:]
+	log_probs = np.zeros((len(sentences), 1))
+	backpointers = np.zeros((max_len, len(sentences), num_tags), dtype=np.int64)
+	for i in range(max_len):
+		lp = log_trans[np.newaxis,:,:] + word_lps[:,i,np.newaxis,:]
+		# Like HMM.word_log_prob, impossible transitions and emissions get -1e10.
+		lp[np.isneginf(lp)] = -1e10
+		lp += log_probs[:,:,np.newaxis]
+		parents = last_argmax(lp, axis = 1)
+		new_log_probs = lp[batch_ids, parents, all_ids[np.newaxis,:]]
+		new_log_probs[~known[:,i][:,np.newaxis] & unknown_mask[np.newaxis,:]] = float('-inf')
+		active = (i < lengths)[:,np.newaxis]
+		if i == 0: # Padding only happens after the first column.
+			log_probs = new_log_probs
+		else:
+			log_probs = np.where(active, new_log_probs, log_probs)
+			parents = np.where(active, parents, all_ids[np.newaxis,:])
+		backpointers[i] = parents
+		log_trans = hmm.log_trans
+
+	# vectorized_viterbi() adds -1e10 to all cells of the last column.
+	k = last_argmax(-1e10 + log_probs, axis = 1) if max_len > 0 else np.zeros((len(sentences),), dtype=np.int64)
+	tags = np.zeros((len(sentences), max_len), dtype=np.int64)
+	for i in range(max_len-1, -1, -1):
+		tags[:,i] = k
+		k = backpointers[i][batch_ids[:,0], k]
+	return [[(word_tpl[0], hmm.tag_list[t], hmm.tag_list[t]) for (word_tpl, t) in zip(sentence, row)]
+		for (sentence, row) in zip(sentences, tags.tolist())]
+
+def last_argmax(arr, axis = 0):
+	""" Returns the indices of the last maximums along an axis, like a loop comparing with >= does. """
+	return arr.shape[axis] - 1 - np.argmax(np.flip(arr, axis), axis = axis)
+
+def vectorized_viterbi(hmm, sentence):
+	""" Implements the Viterbi algorithm for HMMs on the compiled log probability tables.
+	Each column is computed with a single array operation over the (previous tag, tag) pairs,
+	and the best parents are kept in integer backpointer arrays. Unknown words and ties are
+	handled like in viterbi().
+	"""
+	all_ids = np.arange(len(hmm.tag_list))
+	common_ids = np.array([hmm.tag_ids[hmm.common_tag]]) if hmm.common_tag is not None else all_ids[:0]
+	log_trans = hmm.log_start[np.newaxis,:]
+	log_probs = np.zeros((1,))
+	columns = []
+	backpointers = []
+	for word_tpl in sentence:
+		if word_tpl[0] in hmm.vocab: # Word is in our vocabulary
+			tag_ids = all_ids
+		else: # Word is not in our vocabulary, assign the most common tag
+			tag_ids = common_ids
+		lp = log_trans[:,tag_ids] + hmm.word_log_probs(word_tpl[0])[tag_ids]
+		# Like HMM.word_log_prob, impossible transitions and emissions get -1e10.
+		lp[np.isneginf(lp)] = -1e10
+		lp += log_probs[:,np.newaxis]
+		parents = last_argmax(lp, axis = 0)
+		log_probs = lp[parents, np.arange(len(tag_ids))]
+		columns.append(tag_ids)
+		backpointers.append(parents)
+		log_trans = hmm.log_trans[tag_ids]
+
+	if len(columns) == 0:
+		return []
+	# viterbi() adds HMM.end_log_prob of the cells, which is -1e10 for all of them.
+	k = int(last_argmax(-1e10 + log_probs))
+	sent = []
+	for i in range(len(columns)-1, -1, -1):
+		tag = hmm.tag_list[columns[i][k]]
+		sent.insert(0, (sentence[i][0], tag, tag))
+		k = int(backpointers[i][k])
+	return sent
 
 def find_best_parent(hmm, word, tag, parents):
 	""" Finds the best parent for the given word/tag tuple.
@@ -30,15 +150,9 @@ def find_best_parent(hmm, word, tag, parents):
 
 def viterbi(hmm, sentence):
 	""" Implements the Viterbi algorithm for HMMs. """
-	# Find the most common tag
-	max_lp_tag = None
-	max_lp = float('-inf')
-	for tag in hmm.tags:
-		lp = hmm.tag_count(tag)
-		if lp >= max_lp:
-			max_lp = lp
-			max_lp_tag = tag
-	
+	# The most common tag
+	max_lp_tag = hmm.common_tag
+
 	v = []
 	# The initial node for all paths is the start tag
 	start = (None, hmm_train.start_tag, hmm_train.start_tag)
@@ -47,7 +161,7 @@ def viterbi(hmm, sentence):
 	for i, word_tpl in enumerate(sentence, start=1): # Columns
 		v.insert(i,[])
 		if word_tpl[0] in hmm.vocab: # Word is in our vocabulary
-			for j, tag in enumerate(hmm.tags): # Rows
+			for j, tag in enumerate(hmm.tag_list): # Rows
 				bp = find_best_parent(hmm, word_tpl[0],tag, v[i-1])
 				# Add the current word/tag pair, its parent, and its log probability to the array.
 				v[i].insert(j,bp)
@@ -72,13 +186,53 @@ def viterbi(hmm, sentence):
 		ind -= 1
 	return sent
 
+def init_worker(hmm):
+	""" Keeps the HMM in the worker process, so that it is only sent once. """
+	global worker_hmm
+	worker_hmm = hmm
+
+def tag_chunk(chunk, bucket_size = 64):
+	""" POS tags a chunk of sentences with the HMM of the worker process. """
+	return pos_tag(worker_hmm, chunk, bucket_size)
+
+def write_sentences(f, ind, sentences):
+	""" Writes tagged sentences to an open file in the format of save(). """
+	for sentence in sentences:
+		for word_tpl in sentence:
+			f.write(word_tpl[0]+'|'+word_tpl[ind]+'\n')
+		f.write('\n')
+
+def tag_file(hmm, input_filepath, output_filepath, jobs = 1, chunk_size = 1024, bucket_size = 64):
+	""" POS tags a CoNLL file into the output file, streaming the sentences.
+	The sentences are read and tagged in chunks of chunk_size sentences, and written
+	in the original order as soon as their chunk is done. If jobs is greater than 1,
+	the chunks are tagged by that many worker processes, each holding the HMM. At most
+	two chunks per worker are read ahead, so the memory usage does not depend on the
+	size of the input.
+	"""
+	sentences = cpar.iter_sentences(input_filepath)
+	with io.open(output_filepath, 'w', encoding='utf-8') as f:
+		if jobs <= 1:
+			write_sentences(f, hmm.tag_ind, iter_pos_tag(hmm, sentences, chunk_size, bucket_size))
+		else:
+			chunks = iter(lambda: list(islice(sentences, chunk_size)), [])
+			with Pool(jobs, initializer = init_worker, initargs = (hmm,)) as pool:
+				pending = deque()
+				for chunk in chunks:
+					pending.append(pool.apply_async(tag_chunk, (chunk, bucket_size)))
+					if len(pending) >= 2 * jobs:
+						write_sentences(f, hmm.tag_ind, pending.popleft().get())
+				while len(pending) > 0:
+					write_sentences(f, hmm.tag_ind, pending.popleft().get())
+	print('Output written to',output_filepath)
+
 def save(ind, sentences, output_filepath):
-	""" Outputs the tagged sentences to the given filepath. """
+	""" Outputs the tagged sentences to the given filepath.
+	The sentences are written one by one, so they can be a generator
+	(see iter_pos_tag).
+	"""
 	with io.open(output_filepath, 'w', encoding='utf-8') as f:
-		for sentence in sentences:
-			for word_tpl in sentence:
-				f.write(word_tpl[0]+'|'+word_tpl[ind]+'\n')
-			f.write('\n')
+		write_sentences(f, ind, sentences)
 	print('Output written to',output_filepath)
 	
 
@@ -87,8 +241,21 @@ if __name__ == '__main__':
 	""" This program accepts two arguments: the file path to the test file
 	and the file path to the output file. It requires a hmm.conf file to 
 	have been created by train_hmm_tagger.py
+
+	If used, the -b option followed by a number sets the number of sentences
+	of similar lengths that are decoded together (64 by default), and the -j
+	option followed by a number sets the number of worker processes. The test
+	file is streamed, so it can be larger than the memory.
 	"""
 	argv = sys.argv[1:]
+	bucket_size = 64
+	jobs = 1
+	while len(argv) > 1 and argv[0] in ('-b', '-j'):
+		if argv[0] == '-b':
+			bucket_size = int(argv[1])
+		else:
+			jobs = int(argv[1])
+		argv = argv[2:]
 	if len(argv) < 2:
 		print('You must enter a test filepath and output filepath')
 		sys.exit(2)
@@ -99,8 +266,4 @@ if __name__ == '__main__':
 		hmm = hmm_train.HMM()
 		hmm.load(hmm_train.config_path)
 
-		sentences = cpar.get_sentences(test_filepath)
-
-		pt_sentences = pos_tag(hmm, sentences)
-
-		save(hmm.tag_ind, pt_sentences, output_filepath)
\ No newline at end of file
+		tag_file(hmm, test_filepath, output_filepath, jobs, bucket_size = bucket_size)
\ No newline at end of file
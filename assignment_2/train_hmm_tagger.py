@@ -3,6 +3,7 @@ import argparse
 import conll_parser as cpar
 import io, json
 import math
+import numpy as np
 
 start_tag = '<s>'
 end_tag = '<e>'
@@ -39,15 +40,25 @@ def from_dict(dict_obj):
 
 	return obj, dict_obj['count']
 
+def log_count(count):
+	""" Returns the log of a count, or negative infinity if the count is 0. """
+	return math.log(count) if count > 0 else float('-inf')
+
 class HMM:
 	""" A Hidden Markov Model implementation.
 	Constructed for bi-gram POS tagging.
+
+	After training or loading, the counts are compiled into log probability tables
+	(see compile()), which are used for scoring.
 	"""
 	def __init__(self, tags = set([]), tag_ind = -1):
 		self.tags = tags
 		self.tag_ind = tag_ind
 		self.counts = {}
 		self.vocab = set([])
+		self.tag_list = []
+		self.tag_ids = {}
+		self.word_ids = {}
 
 	def add_count(self, obj, amount = 1):
 		""" Adds an amount to the given count object. """
@@ -106,17 +117,89 @@ class HMM:
 		self.add_word_tag_pair(word[0],word[self.tag_ind], amount)
 
 	def train(self, sentences):
-		""" Trains the HMM with the given sentences. """
+		""" Trains the HMM with the given sentences.
+		The sentences are only iterated once, so they can be a generator.
+		The tags of the sentences are added to the tag set.
+		"""
+		tags = set(self.tags)
 		for sentence in sentences:
 			prev_word = (None, start_tag, start_tag)
 			# Count the start states.
 			self.add_tag(start_tag)
 			self.add_word_tag_pair(None,start_tag)
 			for word in sentence:
+				tags.add(word[self.tag_ind])
 				self.add_word_tuple(word,prev_word)
 				prev_word = word
 			# Count the end state.
 			self.add_tag_pair(prev_word[self.tag_ind],end_tag)
+		self.tags = tags
+		self.compile()
+
+	def compile(self):
+		""" Compiles the counts into log probability tables.
+		Tags and words are mapped to integer ids, in the iteration order of the tags and the
+		vocabulary. The tables are a dense log transition matrix (previous tag by tag), the
+		log transition vectors from the start tag and to the end tag, and a sparse log emission
+		matrix (word by tag) in CSR form, whose missing entries have a log probability of
+		negative infinity. Must be called again if counts are added afterwards.
+		"""
+		self.tag_list = list(self.tags)
+		self.tag_ids = dict(zip(self.tag_list, range(0, len(self.tag_list))))
+		self.word_ids = dict(zip(self.vocab, range(0, len(self.vocab))))
+		tag_log_counts = np.array([log_count(self.tag_count(tag)) for tag in self.tag_list])
+		self.log_trans = np.array([[log_count(self.tag_pair_count(prev_tag, tag)) for tag in self.tag_list]
+			for prev_tag in self.tag_list]).reshape((len(self.tag_list), len(self.tag_list))) - tag_log_counts[:,np.newaxis]
+		self.log_start = np.array([log_count(self.tag_pair_count(start_tag, tag)) for tag in self.tag_list]) - \
+			log_count(self.tag_count(start_tag))
+		self.log_end = np.array([log_count(self.tag_pair_count(tag, end_tag)) for tag in self.tag_list]) - tag_log_counts
+		emissions = [[] for word in self.word_ids]
+		for (obj, count) in self.counts.items():
+			if is_sequence(obj) and obj[0] in self.word_ids and obj[1] in self.tag_ids:
+				emissions[self.word_ids[obj[0]]].append((self.tag_ids[obj[1]], log_count(count) - tag_log_counts[self.tag_ids[obj[1]]]))
+		for row in emissions:
+			row.sort()
+		self.emission_indptr = np.cumsum([0] + [len(row) for row in emissions])
+		self.emission_tags = np.array([tag_id for row in emissions for (tag_id, lp) in row], dtype=np.int64)
+		self.emission_log_probs = np.array([lp for row in emissions for (tag_id, lp) in row], dtype=np.float64)
+		# The most common tag, which is assigned to unknown words.
+		self.common_tag = None
+		max_count = float('-inf')
+		for tag in self.tag_list:
+			if self.tag_count(tag) >= max_count:
+				max_count = self.tag_count(tag)
+				self.common_tag = tag
+
+	def word_log_probs(self, word):
+		""" Returns the log emission probabilities of a word for all tags, in the order of the tag ids. """
+		lps = np.full((len(self.tag_list),), float('-inf'))
+		word_id = self.word_ids.get(word)
+		if word_id is not None:
+			start, stop = self.emission_indptr[word_id], self.emission_indptr[word_id+1]
+			lps[self.emission_tags[start:stop]] = self.emission_log_probs[start:stop]
+		return lps
+
+	def word_log_probs_batch(self, words):
+		""" Returns the log emission probabilities of a list of words as a matrix with one row per word. """
+		word_ids = np.array([self.word_ids.get(word, -1) for word in words], dtype=np.int64)
+		lps = np.full((len(words), len(self.tag_list)), float('-inf'))
+		rows = np.flatnonzero(word_ids >= 0)
+		starts = self.emission_indptr[word_ids[rows]]
+		lengths = self.emission_indptr[word_ids[rows]+1] - starts
+		# Positions of all emission entries of the words in the CSR arrays.
+		positions = np.arange(np.sum(lengths)) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+		lps[np.repeat(rows, lengths), self.emission_tags[positions]] = self.emission_log_probs[positions]
+		return lps
+
+	def emission_log_prob(self, word, tag):
+		""" Returns the log emission probability of a word for a single tag. """
+		word_id = self.word_ids.get(word)
+		tag_id = self.tag_ids.get(tag)
+		if word_id is None or tag_id is None:
+			return float('-inf')
+		start, stop = self.emission_indptr[word_id], self.emission_indptr[word_id+1]
+		k = start + np.searchsorted(self.emission_tags[start:stop], tag_id)
+		return float(self.emission_log_probs[k]) if k < stop and self.emission_tags[k] == tag_id else float('-inf')
 
 	def save(self, path = config_path):
 		""" Saves the current state of the HMM to a file. """
@@ -137,6 +220,7 @@ class HMM:
 			self.vocab = set(data['vocab'])
 			self.tag_ind = data['tag_ind']
 			self.counts = dict([from_dict(c) for c in data['counts']])
+		self.compile()
 		print('HMM configuration loaded from',path)
 
 	def word_log_prob(self, prev_tag, tag, word):
@@ -150,21 +234,23 @@ class HMM:
 		we use -1e10 in order to make meaningful choices down the road,
 		which pays off if all posterior probabilities evaluate to 0.
 		"""
-		try:
-			return math.log(self.tag_pair_count(prev_tag, tag)) + math.log(self.word_tag_count(word, tag)) - \
-			math.log(self.tag_count(tag)) - math.log(self.tag_count(prev_tag))
-		except ValueError:
+		tag_id = self.tag_ids.get(tag)
+		if tag_id is None:
 			return -1e10
+		trans = self.log_start[tag_id] if prev_tag == start_tag else \
+			(self.log_trans[self.tag_ids[prev_tag], tag_id] if prev_tag in self.tag_ids else float('-inf'))
+		lp = float(trans) + self.emission_log_prob(word, tag)
+		return lp if lp > float('-inf') else -1e10
 
 	def end_log_prob(self, tag):
 		""" Gets the log probability of having a tag at the end of a sentence.
 		This probability is equal to:
-		Count(prev_tag,end_tag) / Count(prev_tag)
+		Count(tag,end_tag) / Count(tag)
 		"""
-		try:
-			return math.log(self.tag_pair_count(tag, end_tag)) - math.log(self.tag_count(prev_tag))
-		except ValueError:
+		tag_id = self.tag_ids.get(tag)
+		if tag_id is None or self.log_end[tag_id] == float('-inf'):
 			return -1e10
+		return float(self.log_end[tag_id])
 
 if __name__ == '__main__':
 	""" This program accepts one argument: the file path to the training set.
@@ -188,9 +274,9 @@ if __name__ == '__main__':
 	else:
 		print('Using cpostags since tag set was not specified.')
 
-	sentences = cpar.get_sentences(args.training_filepath)
+	# The tags are collected while training, so the file is streamed once.
 	tag_ind = cpar.tag_ind(tag_type)
-	hmm = HMM(cpar.tag_list(sentences, tag_ind), tag_ind)
-	hmm.train(sentences)
+	hmm = HMM(set([]), tag_ind)
+	hmm.train(cpar.iter_sentences(args.training_filepath))
 
 	hmm.save()
\ No newline at end of file